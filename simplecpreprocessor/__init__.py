@@ -2,7 +2,26 @@
 simplepreprocessor expands limited set of C preprocessor macros
 """
 
-from .core import preprocess
+from .core import (preprocess, preprocess_bytes, preprocess_to_file,
+                   preprocess_to_string)
 from .version import __version__
 
-__all__ = ["preprocess", "__version__"]
+__all__ = ["preprocess", "preprocess_bytes", "preprocess_to_file",
+           "preprocess_to_string",
+           "preprocess_async", "preprocess_many", "PreprocessorSession",
+           "__version__"]
+
+
+def __getattr__(name):
+    # asyncio and concurrent.futures are slow to import, so these are only
+    # loaded when needed
+    if name == "preprocess_async":
+        from .aio import preprocess_async
+        return preprocess_async
+    if name == "preprocess_many":
+        from .batch import preprocess_many
+        return preprocess_many
+    if name == "PreprocessorSession":
+        from .session import PreprocessorSession
+        return PreprocessorSession
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -1,8 +1,13 @@
 from simplecpreprocessor import preprocess
+from simplecpreprocessor.core import preprocess_bytes, write_buffered
+from simplecpreprocessor import depends
+from simplecpreprocessor.platform import TARGETS
 import argparse
+import json
+import sys
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--input-file", required=True,
+parser.add_argument("--input-file",
                     help="Header file to parse. Can also be a shim header")
 parser.add_argument("--include-path", action="append",
                     help="Include paths", dest="include_paths",
@@ -10,17 +15,146 @@ parser.add_argument("--include-path", action="append",
 parser.add_argument("--ignore-header", action="append",
                     help="Headers to ignore. Useful for eg CFFI",
                     dest="ignore_headers", default=[])
-parser.add_argument("--output-file", required=True,
+parser.add_argument("--binary", action="store_true",
+                    help="Preprocess bytes without decoding the input, for "
+                    "ASCII compatible encodings")
+parser.add_argument("--target", choices=sorted(TARGETS),
+                    help="Platform to preprocess for, defaults to the host")
+parser.add_argument("--output-file",
                     help="Output file that contains preprocessed header(s)")
+parser.add_argument("--manifest",
+                    help="JSON file with a list of objects with input and "
+                    "output keys to preprocess instead of --input-file")
+parser.add_argument("--dependencies", choices=sorted(depends.FORMATS),
+                    help="Write the headers included by the input file to "
+                    "the output file in given format instead of the "
+                    "preprocessed output")
+parser.add_argument("--dependency-target",
+                    help="Target of the dependency rule, defaults to the "
+                    "output file")
+parser.add_argument("--jobs", type=int, default=None,
+                    help="Number of worker processes used with --manifest "
+                    "or for tokenizing the headers of --input-file")
+parser.add_argument("--token-cache",
+                    help="Directory for caching tokenized headers")
+parser.add_argument("--cache-dir",
+                    help="Directory for caching complete results")
+parser.add_argument("--stats",
+                    help="Write per header statistics of preprocessing "
+                    "--input-file to this file as JSON")
+parser.add_argument("--cache-size", type=int, default=64 * 1024 * 1024,
+                    help="Maximum size of the result cache in bytes")
+
+
+def run_manifest(args, token_cache, result_cache):
+    from simplecpreprocessor.batch import preprocess_many
+    with open(args.manifest) as f:
+        jobs = [(item["input"], item["output"]) for item in json.load(f)]
+    results = preprocess_many(jobs, workers=args.jobs,
+                              include_paths=args.include_paths,
+                              result_cache=result_cache,
+                              ignore_headers=args.ignore_headers,
+                              token_cache=token_cache, target=args.target,
+                              join_lines=True)
+    failed = False
+    for result in results:
+        if result.error is not None:
+            sys.stderr.write("%s: %s\n" % (result.input_file, result.error))
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+def write_dependencies(args):
+    with open(args.input_file) as i:
+        includes = depends.find_dependencies(
+            i, include_paths=args.include_paths,
+            ignore_headers=args.ignore_headers, target=args.target)
+    target = args.dependency_target or args.output_file
+    formatter = depends.FORMATS[args.dependencies]
+    with open(args.output_file, "w") as o:
+        o.write(formatter(target, includes, args.input_file))
+
+
+def write_stats(stats, path):
+    with open(path, "w") as f:
+        json.dump(stats.as_dict(), f, indent=2)
+
+
+def run_binary(args, token_cache):
+    stats = None
+    if args.stats is not None:
+        from simplecpreprocessor.stats import Stats
+        stats = Stats()
+    with open(args.input_file, "rb") as i:
+        with open(args.output_file, "wb") as o:
+            for chunk in preprocess_bytes(
+                    i, include_paths=args.include_paths,
+                    ignore_headers=args.ignore_headers,
+                    token_cache=token_cache, stats=stats,
+                    target=args.target, chunk_size=65536):
+                o.write(chunk)
+    if stats is not None:
+        write_stats(stats, args.stats)
 
 
 def main(args=None):
     args = parser.parse_args(args)
+    if args.manifest is None and (args.input_file is None or
+                                  args.output_file is None):
+        parser.error("--input-file and --output-file are required "
+                     "without --manifest")
+    if args.stats is not None and args.manifest is not None:
+        parser.error("--stats can't be used with --manifest")
+    if args.stats is not None and args.cache_dir is not None:
+        parser.error("--stats can't be used with --cache-dir")
+    if args.binary and (args.manifest is not None or
+                        args.dependencies is not None or
+                        args.cache_dir is not None):
+        parser.error("--binary can't be used with --manifest, "
+                     "--dependencies or --cache-dir")
+    if args.dependencies is not None:
+        if args.manifest is not None:
+            parser.error("--dependencies can't be used with --manifest")
+        write_dependencies(args)
+        return
+    token_cache = None
+    if args.token_cache is not None:
+        from simplecpreprocessor.cache import TokenCache
+        token_cache = TokenCache(args.token_cache)
+    result_cache = None
+    if args.cache_dir is not None:
+        from simplecpreprocessor.cache import ResultCache
+        result_cache = ResultCache(args.cache_dir, args.cache_size)
+    if args.manifest is not None:
+        run_manifest(args, token_cache, result_cache)
+        return
+    if args.binary:
+        run_binary(args, token_cache)
+        return
+    if (token_cache is None and result_cache is None and
+            args.jobs is not None and args.jobs > 1):
+        from simplecpreprocessor.batch import pretokenize
+        token_cache = pretokenize(args.input_file, args.include_paths,
+                                  ignore_headers=args.ignore_headers,
+                                  workers=args.jobs)
+    run = preprocess
+    options = {}
+    if args.stats is not None:
+        from simplecpreprocessor.stats import Stats
+        options["stats"] = stats = Stats()
+    if result_cache is not None:
+        run = result_cache.preprocess
     with open(args.input_file) as i:
         with open(args.output_file, "w") as o:
-            for line in preprocess(i, include_paths=args.include_paths,
-                                   ignore_headers=args.ignore_headers):
-                o.write(line)
+            write_buffered(run(i, include_paths=args.include_paths,
+                               ignore_headers=args.ignore_headers,
+                               token_cache=token_cache,
+                               target=args.target, join_lines=True,
+                               **options), o)
+    if args.stats is not None:
+        write_stats(stats, args.stats)
 
 
-main()
+if __name__ == "__main__":
+    main()
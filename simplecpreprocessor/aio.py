@@ -0,0 +1,101 @@
+import asyncio
+import posixpath
+
+from . import core, filesystem, tokens
+
+
+class DirectoryLoader(object):
+    """
+    Reads headers from the local filesystem on an executor so that the
+    event loop isn't blocked. None uses the default executor of the loop.
+    """
+
+    def __init__(self, executor=None):
+        self.executor = executor
+
+    def _read(self, header_path):
+        try:
+            with open(header_path) as f:
+                return list(f)
+        except IOError:
+            return None
+
+    async def load(self, header_path):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._read,
+                                          header_path)
+
+
+class MemoryLoader(object):
+    """
+    Serves headers from a mapping of header paths to lists of lines.
+    """
+
+    def __init__(self, header_mapping):
+        self.header_mapping = header_mapping
+
+    async def load(self, header_path):
+        return self.header_mapping.get(header_path)
+
+
+class AsyncHeaderHandler(filesystem.HeaderHandler):
+    """
+    Header handler that reads headers through an async loader. A loader
+    has a coroutine method load(header_path) returning the lines of the
+    header or None when it doesn't exist. Headers are resolved and loaded
+    into contents before they are opened, so opening never blocks.
+    """
+
+    def __init__(self, loader, include_paths=(), resolved=None):
+        super(AsyncHeaderHandler, self).__init__(include_paths,
+                                                 cache_contents=True,
+                                                 resolved=resolved)
+        self.loader = loader
+
+    def _open(self, header_path):
+        return None
+
+    def request(self, include_header, anchor_file):
+        anchor_directory, key = self._resolution_key(include_header,
+                                                     anchor_file)
+        if self.resolved.get(key) in self.contents:
+            return None
+        return filesystem.HeaderRequest(include_header, anchor_directory,
+                                        key)
+
+    async def load(self, request):
+        for include_path in self._resolve(request.anchor_directory):
+            header_path = posixpath.join(include_path,
+                                         request.include_header)
+            header_path = posixpath.normpath(header_path)
+            self.resolution_attempts += 1
+            if header_path not in self.contents:
+                lines = await self.loader.load(header_path)
+                if lines is None:
+                    continue
+                self.contents[header_path] = filesystem.FakeFile(
+                    header_path, lines)
+            self.resolved[request.key] = header_path
+            return
+
+
+def preprocess_async(f_object, loader=None, line_ending="\n",
+                     include_paths=(), extra_constants=(),
+                     ignore_headers=(), fold_strings_to_null=False,
+                     tokenizer_class=tokens.Tokenizer,
+                     max_expansion_depth=None, max_expansions=None,
+                     target=None):
+    """
+    Async iterator version of preprocess. Headers are read with loader,
+    which defaults to a DirectoryLoader. f_object itself is read
+    synchronously, so it should already be in memory.
+    """
+    if loader is None:
+        loader = DirectoryLoader()
+    header_handler = AsyncHeaderHandler(loader, include_paths)
+    preprocessor = core.Preprocessor(line_ending, (), header_handler,
+                                     core.predefine(extra_constants, target),
+                                     ignore_headers, fold_strings_to_null,
+                                     None, tokenizer_class,
+                                     max_expansion_depth, max_expansions)
+    return preprocessor.preprocess_async(f_object)
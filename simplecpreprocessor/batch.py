@@ -0,0 +1,149 @@
+import collections
+import os
+import posixpath
+
+from . import cache, core, exceptions, filesystem, tokens
+
+BatchResult = collections.namedtuple("BatchResult", ["input_file",
+                                                     "output_file",
+                                                     "output",
+                                                     "error"])
+
+_worker_handler = None
+_worker_run = None
+_worker_options = None
+
+
+def _init_worker(include_paths, result_cache, options):
+    global _worker_handler, _worker_run, _worker_options
+    _worker_handler = filesystem.HeaderHandler(include_paths)
+    if result_cache is None:
+        _worker_run = core.preprocess
+    else:
+        _worker_run = result_cache.preprocess
+    _worker_options = options
+
+
+def _preprocess_one(job):
+    input_file, output_file = job
+    tmp_path = None
+    try:
+        with open(input_file) as f_in:
+            chunks = _worker_run(f_in, header_handler=_worker_handler,
+                                 **_worker_options)
+            if output_file is None:
+                output = "".join(chunks)
+            else:
+                # written aside so a failure can't leave a partial output
+                tmp_path = "%s.%d.tmp" % (output_file, os.getpid())
+                with open(tmp_path, "w") as f_out:
+                    core.write_buffered(chunks, f_out)
+                os.replace(tmp_path, output_file)
+                output = None
+    except (exceptions.ParseError, IOError, ValueError) as e:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return BatchResult(input_file, output_file, None, str(e))
+    return BatchResult(input_file, output_file, output, None)
+
+
+def preprocess_many(jobs, workers=None, include_paths=(), result_cache=None,
+                    **options):
+    """
+    Preprocesses many input files over a process pool. Jobs are either
+    input file names or (input file, output file) pairs. When an output
+    file is given the result is written there, otherwise it's returned
+    as output. Results are returned in the same order as jobs, with the
+    message of a ParseError, IOError or ValueError (eg undecodable input)
+    stored as error instead of being raised. No output file is written for
+    failed jobs. Each worker keeps its header handler between jobs so include
+    resolution is only done once per worker. Jobs go through result_cache
+    (cache.ResultCache) if one is given. Remaining keyword arguments are
+    passed to preprocess.
+    """
+    jobs = [(job, None) if isinstance(job, str) else tuple(job)
+            for job in jobs]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        _init_worker(include_paths, result_cache, options)
+        return [_preprocess_one(job) for job in jobs]
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker,
+            initargs=(include_paths, result_cache, options)) as executor:
+        return list(executor.map(_preprocess_one, jobs))
+
+
+def _tokenize_header(candidates, line_ending, tokenizer_class):
+    for header_path in candidates:
+        try:
+            with open(header_path) as f:
+                lines = list(f)
+        except IOError:
+            continue
+        f_object = filesystem.FakeFile(header_path, lines)
+        chunks = tokenizer_class(f_object, line_ending).read_chunks()
+        includes = []
+        for line in lines:
+            match = filesystem.INCLUDE_LINE.match(line)
+            if match is not None:
+                includes.append(match.groups())
+        return header_path, cache.serialize_chunks(chunks), includes
+    return None
+
+
+def pretokenize(input_file, include_paths=(), line_ending="\n",
+                ignore_headers=(), tokenizer_class=tokens.Tokenizer,
+                workers=None):
+    """
+    Tokenizes input_file and every header reachable from it through
+    literal #include lines on a process pool. Returns a
+    cache.MemoryTokenCache to be passed as token_cache to preprocess, so
+    that only directive evaluation and expansion are left sequential.
+    Headers are discovered without evaluating conditionals, so some of
+    them may be tokenized without being used.
+    """
+    token_cache = cache.MemoryTokenCache()
+    handler = filesystem.HeaderHandler(include_paths)
+    scheduled = set()
+    done = set()
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = {executor.submit(_tokenize_header, [input_file],
+                                   line_ending, tokenizer_class)}
+        while pending:
+            finished, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                result = future.result()
+                if result is None:
+                    continue
+                header_path, data, includes = result
+                if header_path in done:
+                    continue
+                done.add(header_path)
+                token_cache.add(header_path, line_ending, data)
+                anchor_directory = handler._anchor_directory(header_path)
+                for delimiter, include_header in includes:
+                    if include_header in ignore_headers:
+                        continue
+                    if delimiter == "<":
+                        directory = None
+                    else:
+                        directory = anchor_directory
+                    if (directory, include_header) in scheduled:
+                        continue
+                    scheduled.add((directory, include_header))
+                    candidates = [
+                        posixpath.normpath(posixpath.join(path,
+                                                          include_header))
+                        for path in handler._resolve(directory)]
+                    pending.add(executor.submit(_tokenize_header,
+                                                candidates, line_ending,
+                                                tokenizer_class))
+    return token_cache
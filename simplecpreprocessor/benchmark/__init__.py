@@ -0,0 +1,11 @@
+"""
+Benchmarks for the preprocessor, the tokenizer and the macro expander
+over synthetic header corpora. Run with python -m
+simplecpreprocessor.benchmark.
+"""
+
+from .corpus import CORPORA, Corpus
+from .runner import compare, load_baseline, run_benchmarks, save_baseline
+
+__all__ = ["CORPORA", "Corpus", "compare", "load_baseline",
+           "run_benchmarks", "save_baseline"]
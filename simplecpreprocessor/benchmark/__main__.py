@@ -0,0 +1,53 @@
+from simplecpreprocessor.benchmark import corpus, runner
+import argparse
+import sys
+
+parser = argparse.ArgumentParser(prog="python -m "
+                                 "simplecpreprocessor.benchmark")
+parser.add_argument("--corpus", action="append", dest="corpora",
+                    choices=sorted(corpus.CORPORA),
+                    help="Corpus to run, defaults to all")
+parser.add_argument("--benchmark", action="append", dest="benchmarks",
+                    choices=sorted(runner.BENCHMARKS),
+                    help="Benchmark to run, defaults to all")
+parser.add_argument("--scale", type=int, default=1,
+                    help="Multiplier for the size of the corpora")
+parser.add_argument("--repeat", type=int, default=3,
+                    help="Number of timed runs, the best one is reported")
+parser.add_argument("--save", help="Write the results as a JSON baseline")
+parser.add_argument("--baseline",
+                    help="JSON baseline to compare the results against")
+parser.add_argument("--tolerance", type=float, default=0.1,
+                    help="Allowed relative regression against the baseline")
+
+
+def format_results(results):
+    lines = ["%-40s %12s %14s %14s %12s" % ("benchmark", "seconds",
+                                            "lines/s", "tokens/s",
+                                            "peak bytes")]
+    for name, result in sorted(results.items()):
+        lines.append("%-40s %12.6f %14.0f %14.0f %12d" % (
+            name, result["seconds"], result["lines_per_second"],
+            result["tokens_per_second"], result["peak_memory"]))
+    return "\n".join(lines) + "\n"
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    results = runner.run_benchmarks(args.corpora, args.benchmarks,
+                                    args.scale, args.repeat)
+    sys.stdout.write(format_results(results))
+    if args.save is not None:
+        runner.save_baseline(results, args.save)
+    if args.baseline is not None:
+        baseline = runner.load_baseline(args.baseline)
+        regressions = runner.compare(results, baseline, args.tolerance)
+        for name, metric, previous, current in regressions:
+            sys.stdout.write("regression in %s %s: %g -> %g\n" % (
+                name, metric, previous, current))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
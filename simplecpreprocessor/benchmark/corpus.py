@@ -0,0 +1,106 @@
+import collections
+import posixpath
+
+from .. import filesystem
+
+Corpus = collections.namedtuple("Corpus", ["name", "headers", "input_name",
+                                           "include_paths"])
+
+
+def _header(lines):
+    return ["%s\n" % line for line in lines]
+
+
+def _source_lines(prefix, count):
+    return ["int %s_%d = %d;" % (prefix, i, i) for i in range(count)]
+
+
+def deep_includes(scale=1):
+    """
+    Chain of headers each including the next one.
+    """
+    depth = 40 * scale
+    headers = {}
+    for i in range(depth):
+        lines = ["#ifndef HEADER_%d" % i, "#define HEADER_%d" % i]
+        if i + 1 < depth:
+            lines.append('#include "header_%d.h"' % (i + 1))
+        lines.extend(_source_lines("deep_%d" % i, 20))
+        lines.append("#endif")
+        headers["include/header_%d.h" % i] = _header(lines)
+    headers["main.h"] = _header(["#include <header_0.h>"])
+    return Corpus("deep_includes", headers, "main.h", ["include"])
+
+
+def macro_chains(scale=1):
+    """
+    Macros defined in terms of each other and used on every line.
+    """
+    length = 30
+    lines = ["#define CHAIN_0 1"]
+    lines.extend("#define CHAIN_%d (CHAIN_%d + %d)" % (i, i - 1, i)
+                 for i in range(1, length))
+    for i in range(400 * scale):
+        lines.append("#define LOCAL_%d CHAIN_%d" % (i, i % length))
+        lines.append("int chain_%d = LOCAL_%d * CHAIN_%d;" % (
+            i, i, length - 1))
+    return Corpus("macro_chains", {"main.h": _header(lines)}, "main.h", [])
+
+
+def dead_regions(scale=1):
+    """
+    Large #ifdef regions that are never taken.
+    """
+    lines = []
+    for i in range(20 * scale):
+        lines.append("#ifdef NOT_DEFINED_%d" % i)
+        lines.extend(_source_lines("dead_%d" % i, 200))
+        lines.append("#define DEAD_%d 1" % i)
+        lines.append("#endif")
+        lines.extend(_source_lines("live_%d" % i, 5))
+    return Corpus("dead_regions", {"main.h": _header(lines)}, "main.h", [])
+
+
+def multiline_defines(scale=1):
+    """
+    Defines continued over many lines and their uses.
+    """
+    lines = []
+    for i in range(100 * scale):
+        lines.append("#define MULTI_%d \\" % i)
+        lines.extend("    do { x += %d; /* step %d */ } while (0); \\" % (j, j)
+                     for j in range(15))
+        lines.append("    x")
+        lines.append("int multi_%d = MULTI_%d;" % (i, i))
+    return Corpus("multiline_defines", {"main.h": _header(lines)}, "main.h",
+                  [])
+
+
+def many_include_paths(scale=1):
+    """
+    Headers found only in the last of many include paths.
+    """
+    include_paths = ["include_%d" % i for i in range(60)]
+    headers = {}
+    includes = []
+    for i in range(50 * scale):
+        name = "header_%d.h" % i
+        path = posixpath.join(include_paths[-1], name)
+        headers[path] = _header(_source_lines("path_%d" % i, 10))
+        includes.append("#include <%s>" % name)
+    headers["main.h"] = _header(includes)
+    return Corpus("many_include_paths", headers, "main.h", include_paths)
+
+
+CORPORA = {generator.__name__: generator
+           for generator in [deep_includes, macro_chains, dead_regions,
+                             multiline_defines, many_include_paths]}
+
+
+def header_handler(corpus):
+    return filesystem.FakeHandler(corpus.headers, corpus.include_paths)
+
+
+def input_file(corpus):
+    return filesystem.FakeFile(corpus.input_name,
+                               corpus.headers[corpus.input_name])
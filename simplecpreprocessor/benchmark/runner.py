@@ -0,0 +1,131 @@
+import json
+import time
+import tracemalloc
+
+from .. import core, tokens
+from . import corpus as corpora
+
+METRICS = ("lines_per_second", "tokens_per_second")
+
+
+def _tokenize_all(corpus):
+    count = 0
+    for lines in corpus.headers.values():
+        tokenizer = tokens.Tokenizer(lines, tokens.DEFAULT_LINE_ENDING)
+        for chunk in tokenizer.read_chunks():
+            count += len(chunk)
+    return count
+
+
+def _bench_preprocess(corpus):
+    def run():
+        preprocessor = core.Preprocessor(
+            header_handler=corpora.header_handler(corpus))
+        for _ in preprocessor.preprocess(corpora.input_file(corpus)):
+            pass
+    return run
+
+
+def _bench_tokenizer(corpus):
+    def run():
+        _tokenize_all(corpus)
+    return run
+
+
+def _bench_expander(corpus):
+    preprocessor = core.Preprocessor(
+        header_handler=corpora.header_handler(corpus), emit_source=False)
+    for _ in preprocessor.preprocess(corpora.input_file(corpus)):
+        pass
+    source = [chunk
+              for lines in corpus.headers.values()
+              for chunk in tokens.Tokenizer(
+                  lines, tokens.DEFAULT_LINE_ENDING).read_chunks()
+              if chunk[0].value != "#"]
+
+    def run():
+        expander = tokens.TokenExpander(preprocessor.defines.fork())
+        for chunk in source:
+            for _ in expander.expand_tokens(chunk):
+                pass
+    return run
+
+
+BENCHMARKS = {"preprocess": _bench_preprocess,
+              "tokenizer": _bench_tokenizer,
+              "expander": _bench_expander}
+
+
+def _measure(run, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def run_benchmarks(corpus_names=None, benchmark_names=None, scale=1,
+                   repeat=3):
+    """
+    Runs the benchmarks over the corpora and returns a mapping of
+    "corpus/benchmark" to the best time in seconds, lines and tokens per
+    second and the peak memory use in bytes. Throughput is counted from
+    all lines and tokens of the corpus.
+    """
+    results = {}
+    for corpus_name in corpus_names or sorted(corpora.CORPORA):
+        corpus = corpora.CORPORA[corpus_name](scale)
+        lines = sum(len(header) for header in corpus.headers.values())
+        token_count = _tokenize_all(corpus)
+        for benchmark_name in benchmark_names or sorted(BENCHMARKS):
+            run = BENCHMARKS[benchmark_name](corpus)
+            seconds, peak = _measure(run, repeat)
+            seconds = max(seconds, 1e-9)
+            results["%s/%s" % (corpus_name, benchmark_name)] = {
+                "seconds": seconds,
+                "lines_per_second": lines / seconds,
+                "tokens_per_second": token_count / seconds,
+                "peak_memory": peak,
+            }
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Returns (name, metric, baseline value, current value) for every
+    throughput that dropped or peak memory that grew by more than
+    tolerance compared to baseline.
+    """
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric in METRICS:
+            if current[metric] < previous[metric] * (1 - tolerance):
+                regressions.append((name, metric, previous[metric],
+                                    current[metric]))
+        if current["peak_memory"] > previous["peak_memory"] * (1 + tolerance):
+            regressions.append((name, "peak_memory",
+                                previous["peak_memory"],
+                                current["peak_memory"]))
+    return regressions
+
+
+def save_baseline(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,284 @@
+import hashlib
+import marshal
+import os
+import sys
+
+from . import core, filesystem, tokens
+
+FORMAT_VERSION = 2
+MAGIC = b"SCPT"
+HEADER = MAGIC + bytes([FORMAT_VERSION])
+
+
+def serialize_chunks(chunks):
+    values = []
+    line_nos = []
+    kinds = []
+    chunk_ends = []
+    for chunk in chunks:
+        for token in chunk:
+            values.append(sys.intern(token.value))
+            line_nos.append(token.line_no)
+            kinds.append(sys.intern(token.kind))
+        chunk_ends.append(len(values))
+    return marshal.dumps((values, line_nos, kinds, chunk_ends))
+
+
+def deserialize_chunks(data):
+    values, line_nos, kinds, chunk_ends = marshal.loads(data)
+    chunks = []
+    start = 0
+    for end in chunk_ends:
+        chunk = [tokens.Token(line_nos[i], values[i],
+                              kinds[i] in tokens.WHITESPACE_KINDS, kinds[i])
+                 for i in range(start, end)]
+        chunk[-1].chunk_mark = True
+        chunks.append(chunk)
+        start = end
+    return chunks
+
+
+class TokenCache(object):
+    """
+    On-disk cache of tokenized headers. Entries for files opened from disk
+    are keyed by the path of the header and the line ending, and are reused
+    as long as the mtime and size of the open file are unchanged. Anything
+    else, such as contents cached in memory by a header handler, is keyed
+    by a digest of its lines instead.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def _load(self, entry_path, stamp):
+        try:
+            with open(entry_path, "rb") as f:
+                if f.read(len(HEADER)) != HEADER:
+                    return None
+                cached_stamp, data = marshal.load(f)
+            if tuple(cached_stamp) != stamp:
+                return None
+            return deserialize_chunks(data)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+    def _store(self, entry_path, stamp, chunks):
+        tmp_path = "%s.%d.tmp" % (entry_path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(HEADER)
+                marshal.dump((stamp, serialize_chunks(chunks)), f)
+            os.replace(tmp_path, entry_path)
+        except IOError:
+            pass
+
+    def read_chunks(self, f_object, line_ending,
+                    tokenizer_class=tokens.Tokenizer):
+        binary = isinstance(f_object, filesystem.BytesFile)
+        try:
+            info = os.fstat(f_object.fileno())
+        except (AttributeError, OSError, ValueError):
+            info = None
+        if info is not None:
+            stamp = (info.st_mtime_ns, info.st_size)
+            key = "%s\0%s\0%s" % (os.path.abspath(f_object.name),
+                                  line_ending, binary)
+        else:
+            # not backed by a file on disk, its contents may be older
+            # than whatever the path now holds
+            if not isinstance(f_object, filesystem.FakeFile):
+                f_object = filesystem.FakeFile(
+                    getattr(f_object, "name", None), list(f_object))
+            stamp = ()
+            key = "\0%s\0%s\0%s" % (_digest_lines(f_object.contents),
+                                    line_ending, binary)
+        entry_path = self._entry_path(key)
+        chunks = self._load(entry_path, stamp)
+        if chunks is None:
+            tokenizer = tokenizer_class(f_object, line_ending)
+            chunks = list(tokenizer.read_chunks())
+            self._store(entry_path, stamp, chunks)
+        return chunks
+
+
+class MemoryTokenCache(object):
+    """
+    In memory token cache holding headers serialized with
+    serialize_chunks, keyed by header path and line ending. Headers that
+    aren't in the cache are tokenized as usual.
+    """
+
+    def __init__(self):
+        self.serialized = {}
+
+    def add(self, header_path, line_ending, data):
+        self.serialized[header_path, line_ending] = data
+
+    def read_chunks(self, f_object, line_ending,
+                    tokenizer_class=tokens.Tokenizer):
+        name = getattr(f_object, "name", None)
+        data = self.serialized.get((name, line_ending))
+        if data is None:
+            return tokenizer_class(f_object, line_ending).read_chunks()
+        return deserialize_chunks(data)
+
+
+def _digest_lines(lines):
+    text = "".join(lines)
+    return hashlib.sha256(text.encode("utf-8", "surrogateescape")).hexdigest()
+
+
+class _DigestingPreprocessor(core.Preprocessor):
+    """
+    Records a digest of the lines of every file it tokenizes, so results
+    are stored against the contents that were actually preprocessed
+    rather than whatever is on disk once preprocessing is done.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_DigestingPreprocessor, self).__init__(*args, **kwargs)
+        self.digests = {}
+        self.consistent = True
+
+    def read_chunks(self, f_object):
+        if not isinstance(f_object, filesystem.FakeFile):
+            f_object = filesystem.FakeFile(f_object.name, list(f_object))
+        digest = _digest_lines(f_object.contents)
+        if self.digests.setdefault(f_object.name, digest) != digest:
+            self.consistent = False
+        return super(_DigestingPreprocessor, self).read_chunks(f_object)
+
+
+class ResultCache(object):
+    """
+    Content addressed cache of complete preprocessing results. Entries are
+    keyed by the input, the options affecting the output and the contents
+    of every header opened while preprocessing. The total size of the
+    cache is kept under max_size bytes by evicting least recently used
+    entries.
+    """
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _key(self, lines, anchor_directory, line_ending, include_paths,
+             constants, ignore_headers, fold_strings_to_null, limits):
+        options = (FORMAT_VERSION, anchor_directory, line_ending,
+                   tuple(include_paths),
+                   sorted(constants.items()), sorted(ignore_headers),
+                   fold_strings_to_null, limits)
+        h = hashlib.sha256(repr(options).encode("utf-8"))
+        h.update(_digest_lines(lines).encode("ascii"))
+        return h.hexdigest()
+
+    def _headers_unchanged(self, headers, header_handler):
+        for header_path, digest in headers:
+            f = header_handler._open(header_path)
+            if f is None:
+                return False
+            with f:
+                if _digest_lines(f) != digest:
+                    return False
+        return True
+
+    def _lookup(self, entry_path, header_handler):
+        try:
+            with open(entry_path, "rb") as f:
+                if f.read(len(HEADER)) != HEADER:
+                    return None
+                headers, output = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if not self._headers_unchanged(headers, header_handler):
+            return None
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return output
+
+    def _store(self, entry_path, headers, output):
+        tmp_path = "%s.%d.tmp" % (entry_path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(HEADER)
+                marshal.dump((headers, output), f)
+            os.replace(tmp_path, entry_path)
+        except IOError:
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            try:
+                info = entry.stat()
+            except OSError:
+                continue
+            entries.append((info.st_mtime_ns, info.st_size, entry.path))
+            total += info.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def preprocess(self, f_object, line_ending="\n", include_paths=(),
+                   header_handler=None, extra_constants=(),
+                   ignore_headers=(), fold_strings_to_null=False,
+                   token_cache=None, tokenizer_class=tokens.Tokenizer,
+                   max_expansion_depth=None, max_expansions=None,
+                   target=None, join_lines=False):
+        """
+        Same as core.preprocess but returns the stored output for inputs
+        that were already preprocessed with the same options and headers.
+        """
+        lines = list(f_object)
+        name = getattr(f_object, "name", None)
+        f_object = filesystem.FakeFile(name, lines)
+        anchor_directory = None
+        if isinstance(name, str):
+            anchor_directory = os.path.abspath(os.path.dirname(name))
+        if header_handler is None:
+            header_handler = filesystem.HeaderHandler(())
+        defines = core.predefine(extra_constants, target)
+        constants = {name: "".join(token.value for token in value)
+                     for name, value in defines.items()}
+        key = self._key(lines, anchor_directory, line_ending,
+                        header_handler.include_paths + list(include_paths),
+                        constants, ignore_headers, fold_strings_to_null,
+                        (max_expansion_depth, max_expansions))
+        entry_path = os.path.join(self.directory, key)
+        output = self._lookup(entry_path, header_handler)
+        if output is not None:
+            return iter((output,))
+        preprocessor = _DigestingPreprocessor(
+            line_ending, include_paths, header_handler, defines,
+            ignore_headers, fold_strings_to_null, token_cache,
+            tokenizer_class, max_expansion_depth, max_expansions,
+            join_lines=join_lines)
+        return self._run(preprocessor, f_object, entry_path)
+
+    def _run(self, preprocessor, f_object, entry_path):
+        output = []
+        for chunk in preprocessor.preprocess(f_object):
+            output.append(chunk)
+            yield chunk
+        if not preprocessor.consistent:
+            return
+        opened = (header_path for _, header_path in preprocessor.includes)
+        headers = [(header_path, preprocessor.digests[header_path])
+                   for header_path in dict.fromkeys(opened)]
+        self._store(entry_path, headers, "".join(output))
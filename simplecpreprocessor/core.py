@@ -15,42 +15,192 @@ def constants_to_token_constants(constants):
             for key, value in constants.items()}
 
 
-TOKEN_CONSTANTS = constants_to_token_constants(platform.PLATFORM_CONSTANTS)
+_TOKEN_CONSTANTS = {}
+
+
+def token_constants(target=None):
+    """
+    Returns the constants of target (see platform.TARGETS), or of the host
+    when target is None, converted to tokens. Tables are built on first
+    use and shared afterwards, so they must not be modified.
+    """
+    constants = _TOKEN_CONSTANTS.get(target)
+    if constants is None:
+        constants = constants_to_token_constants(
+            platform.target_constants(target))
+        _TOKEN_CONSTANTS[target] = constants
+    return constants
+
+
+def __getattr__(name):
+    if name == "TOKEN_CONSTANTS":
+        return token_constants()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+UNDEFINED = object()
 
 
 class Defines(object):
-    def __init__(self, base):
-        self.defines = base.copy()
+    """
+    Macro table made of read-only layers, topmost first, and a private
+    delta that receives all writes. Layers are shared instead of copied so
+    that fork and snapshot are O(1). Layers may be plain dicts or other
+    Defines, which contribute their current state.
+    """
+    MAX_LAYERS = 8
+
+    def __init__(self, *layers):
+        flattened = []
+        for layer in layers:
+            if isinstance(layer, Defines):
+                flattened.extend(layer.snapshot())
+            else:
+                flattened.append(layer)
+        self.layers = tuple(flattened)
+        self.delta = {}
+        self.expansions = {}
+        self.dependents = {}
+
+    def expansion(self, key):
+        return self.expansions.get(key)
+
+    def store_expansion(self, key, expansion):
+        self.expansions[key] = expansion
+        for dependency in expansion.dependencies:
+            self.dependents.setdefault(dependency, set()).add(key)
+
+    def _invalidate(self, key):
+        for name in self.dependents.pop(key, ()):
+            self.expansions.pop(name, None)
 
     def get(self, key, default=None):
-        return self.defines.get(key, default)
+        if key in self.delta:
+            value = self.delta[key]
+        else:
+            for layer in self.layers:
+                if key in layer:
+                    value = layer[key]
+                    break
+            else:
+                return default
+        if value is UNDEFINED:
+            return default
+        return value
 
     def __delitem__(self, key):
-        self.defines.pop(key, None)
+        self._invalidate(key)
+        self.delta[key] = UNDEFINED
 
     def __setitem__(self, key, value):
-        self.defines[key] = value
+        self._invalidate(key)
+        self.delta[key] = value
 
     def __contains__(self, key):
-        return key in self.defines
+        return self.get(key, UNDEFINED) is not UNDEFINED
+
+    def items(self):
+        merged = {}
+        for layer in reversed((self.delta,) + self.layers):
+            merged.update(layer)
+        return [(key, value) for key, value in merged.items()
+                if value is not UNDEFINED]
+
+    def snapshot(self):
+        """
+        Returns the current state as a tuple of read-only layers that can
+        be passed to Defines or restore.
+        """
+        if self.delta:
+            self.layers = (self.delta,) + self.layers
+            self.delta = {}
+            if len(self.layers) > self.MAX_LAYERS:
+                self.layers = (dict(self.items()),)
+        return self.layers
+
+    def restore(self, snapshot):
+        self.layers = snapshot
+        self.delta = {}
+        self.expansions = {}
+        self.dependents = {}
+
+    def fork(self):
+        return Defines(*self.snapshot())
 
 
 class Preprocessor(object):
+    """
+    Directives and pragmas are dispatched through the directives and
+    pragmas tables, which are built from the process_* and
+    process_pragma_* methods of the class. Extra handlers can be added to
+    an instance with register_directive and register_pragma.
+    """
+    directives = {}
+    pragmas = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super(Preprocessor, cls).__init_subclass__(**kwargs)
+        cls.build_dispatch_tables()
+
+    @classmethod
+    def build_dispatch_tables(cls):
+        directives = dict(cls.directives)
+        pragmas = dict(cls.pragmas)
+        for name in dir(cls):
+            if name.startswith("process_pragma_"):
+                pragmas[name[len("process_pragma_"):]] = getattr(cls, name)
+            elif (name.startswith("process_") and
+                    name != "process_source_chunks"):
+                directives[name[len("process_"):]] = getattr(cls, name)
+        cls.directives = directives
+        cls.pragmas = pragmas
+
+    def register_directive(self, name, handler):
+        """
+        Handles #name with handler for this preprocessor. The handler is
+        called with the preprocessor, line_no and chunk keyword arguments
+        and may return an iterable of output chunks.
+        """
+        if "directives" not in vars(self):
+            self.directives = dict(self.directives)
+        self.directives[name] = handler
+
+    def register_pragma(self, name, handler):
+        """
+        Handles #pragma name with handler for this preprocessor. The
+        handler is called like directive handlers.
+        """
+        if "pragmas" not in vars(self):
+            self.pragmas = dict(self.pragmas)
+        self.pragmas[name] = handler
 
     def __init__(self, line_ending=tokens.DEFAULT_LINE_ENDING,
                  include_paths=(), header_handler=None,
-                 platform_constants=TOKEN_CONSTANTS,
-                 ignore_headers=(), fold_strings_to_null=False):
+                 platform_constants=None,
+                 ignore_headers=(), fold_strings_to_null=False,
+                 token_cache=None, tokenizer_class=tokens.Tokenizer,
+                 max_expansion_depth=None, max_expansions=None,
+                 emit_source=True, stats=None, join_lines=False):
         self.ignore_headers = ignore_headers
         self.include_once = {}
+        if platform_constants is None:
+            platform_constants = token_constants()
         self.defines = Defines(platform_constants)
         self.constraints = []
         self.ignore = False
         self.line_ending = line_ending
         self.last_constraint = None
         self.header_stack = []
+        self.includes = []
+        self.emit_source = emit_source
+        self.join_lines = join_lines
+        self.stats = stats
         self.fold_strings_to_null = fold_strings_to_null
-        self.token_expander = tokens.TokenExpander(self.defines)
+        self.token_expander = tokens.TokenExpander(self.defines,
+                                                   max_expansion_depth,
+                                                   max_expansions)
+        self.token_cache = token_cache
+        self.tokenizer_class = tokenizer_class
         if header_handler is None:
             self.headers = filesystem.HeaderHandler(include_paths)
         else:
@@ -106,19 +256,20 @@ class Preprocessor(object):
             self.constraints.append((Tag.IFDEF, condition, False, line_no))
 
     def process_pragma(self, **kwargs):
+        if self.ignore:
+            return
         chunk = kwargs["chunk"]
         line_no = kwargs["line_no"]
         pragma = None
         for token in chunk:
             if not token.whitespace:
-                method_name = "process_pragma_%s" % token.value
-                pragma = getattr(self, method_name, None)
+                pragma = self.pragmas.get(token.value)
                 break
         if pragma is None:
             s = "Unsupported pragma %s on line %s" % (token.value, line_no)
             raise exceptions.ParseError(s)
         else:
-            ret = pragma(chunk=chunk, line_no=line_no)
+            ret = pragma(self, chunk=chunk, line_no=line_no)
             if ret is not None:
                 yield from ret
 
@@ -126,6 +277,9 @@ class Preprocessor(object):
         self.include_once[self.current_name()] = Tag.PRAGMA_ONCE
 
     def process_pragma_pack(self, chunk, **_):
+        if self.join_lines:
+            yield "#pragma" + "".join([token.value for token in chunk])
+            return
         yield "#pragma"
         for token in chunk:
             yield token.value
@@ -155,13 +309,40 @@ class Preprocessor(object):
         del self.defines[undefine]
 
     def process_source_chunks(self, chunk):
-        if not self.ignore:
+        if not self.ignore and self.emit_source:
+            if self.join_lines:
+                yield "".join(self.expand_values(chunk))
+                return
             for token in self.token_expander.expand_tokens(chunk):
-                if self.fold_strings_to_null and tokens.is_string(token.value):
+                if (self.fold_strings_to_null and
+                        token.kind == tokens.STRING):
                     yield "NULL"
                 else:
                     yield token.value
 
+    def expand_values(self, chunk):
+        expanded = self.token_expander.expand_tokens(chunk)
+        if self.fold_strings_to_null:
+            return ["NULL" if token.kind == tokens.STRING else token.value
+                    for token in expanded]
+        return [token.value for token in expanded]
+
+    def _process_source_chunks_with_stats(self, chunk, header_stats):
+        expander = self.token_expander
+        expansions = expander.expansions
+        expander.deepest = 0
+        if self.join_lines and not self.ignore and self.emit_source:
+            values = self.expand_values(chunk)
+            header_stats.tokens_emitted += len(values)
+            yield "".join(values)
+        else:
+            for token in self.process_source_chunks(chunk):
+                header_stats.tokens_emitted += 1
+                yield token
+        header_stats.expansions += expander.expansions - expansions
+        header_stats.expansion_depth = max(header_stats.expansion_depth,
+                                           expander.deepest)
+
     def skip_file(self, name):
         item = self.include_once.get(name)
         if item is Tag.PRAGMA_ONCE:
@@ -178,15 +359,29 @@ class Preprocessor(object):
 
     def _read_header(self, header, error, anchor_file=None):
         if header not in self.ignore_headers:
+            attempts = self.headers.resolution_attempts
+            request = self.headers.request(header, anchor_file)
+            if request is not None:
+                yield request
             f = self.headers.open_header(header, self.skip_file, anchor_file)
+            if self.stats is not None:
+                header_stats = self.stats.current
+                header_stats.resolution_attempts += (
+                    self.headers.resolution_attempts - attempts)
+                if f is filesystem.SKIP_FILE:
+                    header_stats.skip_file_hits += 1
             if f is None:
                 raise error
             elif f is not filesystem.SKIP_FILE:
+                includer = getattr(self.header_stack[-1], "name", None)
+                self.includes.append((includer, f.name))
                 with f:
                     for chunk in self.preprocess(f):
                         yield chunk
 
     def process_include(self, **kwargs):
+        if self.ignore:
+            return
         chunk = kwargs["chunk"]
         line_no = kwargs["line_no"]
         for token in chunk:
@@ -214,28 +409,56 @@ class Preprocessor(object):
             return
         self.include_once[self.current_name()] = constraint, constraint_type
 
+    def read_chunks(self, f_object):
+        if self.token_cache is not None:
+            return self.token_cache.read_chunks(f_object, self.line_ending,
+                                                self.tokenizer_class)
+        tokenizer = self.tokenizer_class(f_object, self.line_ending,
+                                         self.skip_lines)
+        return tokenizer.read_chunks()
+
+    def skip_lines(self):
+        return self.ignore or not self.emit_source
+
     def preprocess(self, f_object, depth=0):
         self.header_stack.append(f_object)
-        tokenizer = tokens.Tokenizer(f_object, self.line_ending)
-        for chunk in tokenizer.read_chunks():
+        stats = self.stats
+        lines = 0
+        if stats is not None:
+            header_stats = stats.enter_header(getattr(f_object, "name",
+                                                      None))
+        for chunk in self.read_chunks(f_object):
             self.last_constraint = None
+            if stats is not None:
+                header_stats.tokens_lexed += len(chunk)
+                lines = chunk[-1].line_no + 1
             if chunk[0].value == "#":
                 line_no = chunk[0].line_no
                 macro_name = chunk[1].value
                 macro_chunk = chunk[2:]
-                macro = getattr(self, "process_%s" % macro_name, None)
+                macro = self.directives.get(macro_name)
                 if macro is None:
                     fmt = "Line number %s contains unsupported macro %s"
                     raise exceptions.ParseError(fmt % (line_no, macro_name))
-                ret = macro(line_no=line_no, chunk=macro_chunk)
+                if stats is not None:
+                    directives = header_stats.directives
+                    directives[macro_name] = directives.get(macro_name,
+                                                            0) + 1
+                ret = macro(self, line_no=line_no, chunk=macro_chunk)
                 if ret is not None:
                     for token in ret:
                         yield token
-            else:
+            elif stats is None:
                 for token in self.process_source_chunks(chunk):
                     yield token
+            else:
+                for token in self._process_source_chunks_with_stats(
+                        chunk, header_stats):
+                    yield token
         self.check_fullfile_guard()
         self.header_stack.pop()
+        if stats is not None:
+            stats.exit_header(lines)
         if not self.header_stack and self.constraints:
             constraint_type, name, _, line_no = self.constraints[-1]
             fmt = "{tag} {name} from line {line_no} left open"
@@ -243,20 +466,156 @@ class Preprocessor(object):
                                                    name=name,
                                                    line_no=line_no))
 
+    async def preprocess_async(self, f_object):
+        """
+        Same as preprocess but as an async iterator. Headers requested by
+        the header handler (eg aio.AsyncHeaderHandler) are loaded with
+        await so other tasks can run while they are read.
+        """
+        for chunk in self.preprocess(f_object):
+            if isinstance(chunk, filesystem.HeaderRequest):
+                await self.headers.load(chunk)
+            else:
+                yield chunk
+
+
+Preprocessor.build_dispatch_tables()
+
+
+def predefine(constants=(), target=None):
+    """
+    Returns Defines with the given constants layered over the platform
+    constants of target, or of the host if target is None. Constants may
+    be a mapping or pairs of strings, or existing Defines.
+    """
+    base = token_constants(target)
+    if isinstance(constants, Defines):
+        return Defines(constants, base)
+    constants = dict(constants)
+    if not constants:
+        return Defines(base)
+    return Defines(constants_to_token_constants(constants), base)
+
 
 def preprocess(f_object, line_ending="\n", include_paths=(),
                header_handler=None,
                extra_constants=(),
-               ignore_headers=(), fold_strings_to_null=False):
+               ignore_headers=(), fold_strings_to_null=False,
+               token_cache=None, tokenizer_class=tokens.Tokenizer,
+               max_expansion_depth=None, max_expansions=None, stats=None,
+               target=None, join_lines=False, chunk_size=None):
     r"""
     This preprocessor yields chunks of text that combined results in lines
     delimited with given line ending. There is always a final line ending.
+    Tokenized headers are reused from token_cache (eg cache.TokenCache)
+    when one is given. Passing tokens.BufferTokenizer as tokenizer_class
+    tokenizes each file with a single scan over its whole contents, and
+    tokens.ArrayTokenizer keeps tokens in compact arrays to save memory.
+    extra_constants may be a Defines built once with predefine to avoid
+    converting the same constants on every call. max_expansion_depth and
+    max_expansions bound the work spent on macro expansion, ParseError is
+    raised when they are exceeded. Per header counters and timings are
+    collected to stats (stats.Stats) if given. target selects the platform
+    constants (see platform.TARGETS) instead of detecting the host.
+    Chunks are single tokens unless join_lines is set, in which case each
+    chunk is a whole line. With chunk_size, lines are further combined
+    into chunks of at least chunk_size characters.
     """
-    platform_constants = platform.PLATFORM_CONSTANTS.copy()
-    platform_constants.update(extra_constants)
     preprocessor = Preprocessor(line_ending, include_paths, header_handler,
-                                constants_to_token_constants(
-                                    platform_constants
-                                ),
-                                ignore_headers, fold_strings_to_null)
-    return preprocessor.preprocess(f_object)
+                                predefine(extra_constants, target),
+                                ignore_headers, fold_strings_to_null,
+                                token_cache, tokenizer_class,
+                                max_expansion_depth, max_expansions,
+                                stats=stats,
+                                join_lines=join_lines or bool(chunk_size))
+    chunks = preprocessor.preprocess(f_object)
+    if chunk_size:
+        return combine_chunks(chunks, chunk_size)
+    return chunks
+
+
+def _latin1(value):
+    if isinstance(value, bytes):
+        return value.decode("latin-1")
+    return value
+
+
+def preprocess_bytes(f_object, line_ending=b"\n", include_paths=(),
+                     header_handler=None, extra_constants=(),
+                     ignore_headers=(), fold_strings_to_null=False,
+                     token_cache=None, tokenizer_class=tokens.Tokenizer,
+                     max_expansion_depth=None, max_expansions=None,
+                     stats=None, target=None, chunk_size=None):
+    """
+    Same as preprocess for bytes in any ASCII compatible encoding. f_object
+    is a binary file or a filesystem.BytesFile and output is bytes, one
+    line per chunk or chunk_size sized chunks. Bytes outside ASCII are
+    passed through unchanged. header_handler, if given, should be created
+    with binary=True. extra_constants may be bytes or str.
+    """
+    if not isinstance(f_object, filesystem.BytesFile):
+        f_object = filesystem.BytesFile.from_bytes(
+            getattr(f_object, "name", None), f_object.read())
+    if header_handler is None:
+        header_handler = filesystem.HeaderHandler(include_paths, binary=True)
+        include_paths = ()
+    if not isinstance(extra_constants, Defines):
+        extra_constants = [(_latin1(key), _latin1(value))
+                           for key, value in dict(extra_constants).items()]
+    chunks = preprocess(f_object, _latin1(line_ending), include_paths,
+                        header_handler, extra_constants,
+                        [_latin1(header) for header in ignore_headers],
+                        fold_strings_to_null, token_cache, tokenizer_class,
+                        max_expansion_depth, max_expansions, stats, target,
+                        join_lines=True, chunk_size=chunk_size)
+    return (chunk.encode("latin-1") for chunk in chunks)
+
+
+def combine_chunks(chunks, chunk_size):
+    """
+    Joins consecutive chunks of text to chunks of at least chunk_size
+    characters. The last chunk may be shorter.
+    """
+    buffered = []
+    size = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            yield "".join(buffered)
+            buffered = []
+            size = 0
+    if buffered:
+        yield "".join(buffered)
+
+
+def write_buffered(chunks, f_out, buffer_size=16384):
+    """
+    Writes chunks of text to f_out joining them to batches of buffer_size
+    chunks so that there is one write per batch instead of one per chunk.
+    """
+    buffered = []
+    for chunk in chunks:
+        buffered.append(chunk)
+        if len(buffered) >= buffer_size:
+            f_out.write("".join(buffered))
+            buffered = []
+    if buffered:
+        f_out.write("".join(buffered))
+
+
+def preprocess_to_file(f_in, f_out, buffer_size=16384, **kwargs):
+    """
+    Preprocesses f_in and writes the result to f_out with bulk writes.
+    Keyword arguments are passed to preprocess.
+    """
+    write_buffered(preprocess(f_in, **kwargs), f_out, buffer_size)
+
+
+def preprocess_to_string(f_object, **kwargs):
+    """
+    Preprocesses f_object and returns the result as a single string.
+    Keyword arguments are passed to preprocess.
+    """
+    kwargs.setdefault("join_lines", True)
+    return "".join(preprocess(f_object, **kwargs))
@@ -0,0 +1,57 @@
+import json
+
+from . import core, tokens
+
+
+def find_dependencies(f_object, line_ending=tokens.DEFAULT_LINE_ENDING,
+                      include_paths=(), header_handler=None,
+                      extra_constants=(), ignore_headers=(),
+                      tokenizer_class=tokens.Tokenizer, target=None):
+    """
+    Walks the includes of f_object honouring conditionals and include
+    guards without expanding macros or producing output for source lines.
+    Returns (includer, header) pairs in the order headers were opened.
+    """
+    preprocessor = core.Preprocessor(line_ending, include_paths,
+                                     header_handler,
+                                     core.predefine(extra_constants, target),
+                                     ignore_headers,
+                                     tokenizer_class=tokenizer_class,
+                                     emit_source=False)
+    for _ in preprocessor.preprocess(f_object):
+        pass
+    return preprocessor.includes
+
+
+def unique_headers(includes):
+    return list(dict.fromkeys(header for _, header in includes))
+
+
+def format_makefile(target, includes, source=None):
+    """
+    Formats dependencies as a Makefile rule for target like cc -M does.
+    """
+    prerequisites = unique_headers(includes)
+    if source is not None:
+        prerequisites.insert(0, source)
+    words = [name.replace(" ", "\\ ") for name in [target + ":"] +
+             prerequisites]
+    return " \\\n  ".join(words) + "\n"
+
+
+def format_json(target, includes, source=None):
+    graph = {}
+    for includer, header in includes:
+        graph.setdefault(includer, []).append(header)
+    return json.dumps({"target": target,
+                       "source": source,
+                       "dependencies": unique_headers(includes),
+                       "graph": [[includer, headers]
+                                 for includer, headers in graph.items()]},
+                      indent=2) + "\n"
+
+
+FORMATS = {
+    "make": format_makefile,
+    "json": format_json,
+}
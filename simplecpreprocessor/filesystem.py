@@ -1,48 +1,211 @@
+import collections
+import io
 import posixpath
 import os.path
+import re
+
+from . import tokens
 
 SKIP_FILE = object()
 
+INCLUDE_LINE = re.compile(r'\s*#\s*include\s*([<"])([^>"]+)[>"]')
+
+HeaderRequest = collections.namedtuple("HeaderRequest", ["include_header",
+                                                         "anchor_directory",
+                                                         "key"])
+
 
 class HeaderHandler(object):
+    """
+    Resolves and opens headers. With cache_contents, header contents are
+    read once and kept in memory. With index_directories, each directory
+    is listed once and candidates missing from the listing are not
+    opened at all. Listings are refreshed when the mtime of the directory
+    changes if check_mtime is set. Indexing assumes that the names of
+    headers match the case of the files on disk.
+
+    Resolved paths are cached in resolved, keyed by the header name for
+    <> includes and by the directory of the including file and the header
+    name for "" includes. The mapping may be shared between handlers with
+    the same include paths.
+
+    With an executor (eg concurrent.futures.ThreadPoolExecutor), every
+    loaded header is scanned for #include lines and the headers they name
+    are resolved and read into contents in the background. Contents are
+    always cached when prefetching.
 
-    def __init__(self, include_paths):
+    With binary, headers are read as bytes and opened as BytesFile.
+    """
+
+    def __init__(self, include_paths, cache_contents=False,
+                 index_directories=False, check_mtime=False, resolved=None,
+                 executor=None, binary=False):
         self.include_paths = list(include_paths)
-        self.resolved = {}
+        self.binary = binary
+        self.resolved = {} if resolved is None else resolved
+        if cache_contents or executor is not None:
+            self.contents = {}
+        else:
+            self.contents = None
+        self.index = {} if index_directories else None
+        self.check_mtime = check_mtime
+        self.executor = executor
+        self.resolution_attempts = 0
+        self.pending = {}
+        self.scheduled = set()
+        self.lock = None
+        if executor is not None:
+            # only prefetching from the executor needs locking
+            import threading
+            self.lock = threading.Lock()
 
     def _open(self, header_path):
         try:
+            if self.binary:
+                with open(header_path, "rb") as f:
+                    return BytesFile.from_bytes(f.name, f.read())
             f = open(header_path)
         except IOError:
             return None
         else:
             return f
 
+    def _directory_stamp(self, directory):
+        try:
+            return os.stat(directory or os.curdir).st_mtime_ns
+        except OSError:
+            return None
+
+    def _listdir(self, directory):
+        try:
+            with os.scandir(directory or os.curdir) as entries:
+                return frozenset(entry.name for entry in entries)
+        except OSError:
+            return frozenset()
+
+    def _exists(self, header_path):
+        if self.index is None:
+            return True
+        directory, name = posixpath.split(header_path)
+        entry = self.index.get(directory)
+        if entry is not None and self.check_mtime:
+            if entry[0] != self._directory_stamp(directory):
+                entry = None
+        if entry is None:
+            stamp = self._directory_stamp(directory)
+            entry = self.index[directory] = stamp, self._listdir(directory)
+        return name in entry[1]
+
+    def _load(self, header_path):
+        if self.contents is None:
+            return self._open(header_path)
+        f = self.contents.get(header_path)
+        if f is None:
+            f = self._open(header_path)
+            if f is not None:
+                f = in_memory(f)
+                self.contents[header_path] = f
+                if self.executor is not None:
+                    self._prefetch_includes(f.name, f.contents)
+        return f
+
+    def _prefetch_includes(self, header_path, lines):
+        anchor_directory = self._anchor_directory(header_path)
+        for line in lines:
+            match = INCLUDE_LINE.match(line)
+            if match is None:
+                continue
+            delimiter, include_header = match.groups()
+            if delimiter == "<":
+                directory, key = None, include_header
+            else:
+                directory = anchor_directory
+                key = anchor_directory, include_header
+            with self.lock:
+                if key in self.scheduled or key in self.resolved:
+                    continue
+                self.scheduled.add(key)
+                try:
+                    self.pending[key] = self.executor.submit(
+                        self._fetch, include_header, directory)
+                except RuntimeError:
+                    return
+
+    def _fetch(self, include_header, anchor_directory):
+        for include_path in self._resolve(anchor_directory):
+            header_path = posixpath.join(include_path, include_header)
+            header_path = posixpath.normpath(header_path)
+            if header_path in self.contents:
+                return header_path, None
+            if not self._exists(header_path):
+                continue
+            f = self._open(header_path)
+            if f:
+                f = in_memory(f)
+                self._prefetch_includes(f.name, f.contents)
+                return f.name, f
+        return None
+
+    def _collect(self, key):
+        with self.lock:
+            future = self.pending.pop(key, None)
+        if future is None:
+            return
+        result = future.result()
+        if result is not None:
+            header_path, f = result
+            if f is not None:
+                self.contents.setdefault(header_path, f)
+            self.resolved.setdefault(key, header_path)
+
     def add_include_paths(self, include_paths):
         self.include_paths.extend(include_paths)
 
-    def _resolve(self, anchor_file):
-        if anchor_file is not None:
-            if os.path.sep != posixpath.sep:
-                anchor_file = anchor_file.replace(os.path.sep,
-                                                  posixpath.sep)
-            yield posixpath.dirname(anchor_file)
+    def _anchor_directory(self, anchor_file):
+        if os.path.sep != posixpath.sep:
+            anchor_file = anchor_file.replace(os.path.sep, posixpath.sep)
+        return posixpath.dirname(anchor_file)
+
+    def _resolve(self, anchor_directory):
+        if anchor_directory is not None:
+            yield anchor_directory
         for include_path in self.include_paths:
             yield include_path
 
+    def _resolution_key(self, include_header, anchor_file):
+        if anchor_file is None:
+            return None, include_header
+        anchor_directory = self._anchor_directory(anchor_file)
+        return anchor_directory, (anchor_directory, include_header)
+
+    def request(self, include_header, anchor_file):
+        """
+        Returns a HeaderRequest that has to be loaded before the header
+        can be opened, or None when open_header can be called directly.
+        """
+        return None
+
     def open_header(self, include_header, skip_file, anchor_file):
-        header_path = self.resolved.get(include_header)
+        anchor_directory, key = self._resolution_key(include_header,
+                                                     anchor_file)
+        if self.pending:
+            self._collect(key)
+        header_path = self.resolved.get(key)
         f = None
         if header_path is not None:
             if skip_file(header_path):
                 return SKIP_FILE
             else:
-                return self._open(header_path)
-        for include_path in self._resolve(anchor_file):
+                return self._load(header_path)
+        for include_path in self._resolve(anchor_directory):
             header_path = posixpath.join(include_path, include_header)
-            f = self._open(posixpath.normpath(header_path))
+            header_path = posixpath.normpath(header_path)
+            self.resolution_attempts += 1
+            if not self._exists(header_path):
+                continue
+            f = self._load(header_path)
             if f:
-                self.resolved[include_header] = f.name
+                self.resolved[key] = f.name
                 break
         return f
 
@@ -64,18 +227,58 @@ class FakeFile(object):
         pass
 
 
+def in_memory(f):
+    if isinstance(f, FakeFile):
+        return f
+    with f:
+        return FakeFile(f.name, list(f))
+
+
+class BytesFile(FakeFile):
+    """
+    In memory file made from bytes in any ASCII compatible encoding. The
+    bytes are mapped one to one to characters with latin-1, without
+    newline translation, and tokenized with tokens.ASCII_TOKEN so that
+    only ASCII bytes have a meaning. Encoding the output with latin-1
+    gives back the original bytes.
+    """
+    token_pattern = tokens.ASCII_TOKEN
+
+    def __init__(self, name, text):
+        lines = list(io.StringIO(text, newline="\n"))
+        super(BytesFile, self).__init__(name, lines)
+        self.text = text
+
+    @classmethod
+    def from_bytes(cls, name, data):
+        return cls(name, data.decode("latin-1"))
+
+    def read(self):
+        return self.text
+
+
 class FakeHandler(HeaderHandler):
 
-    def __init__(self, header_mapping, include_paths=()):
+    def __init__(self, header_mapping, include_paths=(), **kwargs):
         self.header_mapping = header_mapping
-        super(FakeHandler, self).__init__(list(include_paths))
+        super(FakeHandler, self).__init__(list(include_paths), **kwargs)
 
     def _open(self, header_path):
         contents = self.header_mapping.get(header_path)
-        if contents is not None:
+        if isinstance(contents, bytes):
+            return BytesFile.from_bytes(header_path, contents)
+        elif contents is not None:
             return FakeFile(header_path, contents)
         else:
             return None
 
+    def _directory_stamp(self, directory):
+        return None
+
+    def _listdir(self, directory):
+        return frozenset(posixpath.basename(path)
+                         for path in self.header_mapping
+                         if posixpath.dirname(path) == directory)
+
     def parent_open(self, header_path):
         return super(FakeHandler, self)._open(header_path)
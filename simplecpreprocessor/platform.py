@@ -2,6 +2,13 @@ from __future__ import absolute_import
 import platform
 from .exceptions import UnsupportedPlatform
 
+TARGETS = {
+    "linux-32": ("Linux", "32bit"),
+    "linux-64": ("Linux", "64bit"),
+    "windows-32": ("Windows", "32bit"),
+    "windows-64": ("Windows", "64bit"),
+}
+
 
 def extract_platform_spec():
     system = platform.system()
@@ -50,8 +57,7 @@ def calculate_linux_constants(bitness):
     return constants
 
 
-def calculate_platform_constants():
-    system, bitness = extract_platform_spec()
+def calculate_constants(system, bitness):
     if system == "Windows":
         constants = calculate_windows_constants(bitness)
     elif system == "Linux":
@@ -62,4 +68,32 @@ def calculate_platform_constants():
     return constants
 
 
-PLATFORM_CONSTANTS = calculate_platform_constants()
+def calculate_platform_constants():
+    return calculate_constants(*extract_platform_spec())
+
+
+_CONSTANTS = {}
+
+
+def target_constants(target=None):
+    """
+    Returns the constants of target, one of TARGETS, or of the host when
+    target is None. The host is only probed on first use and the result
+    is memoized. The returned mapping must not be modified.
+    """
+    constants = _CONSTANTS.get(target)
+    if constants is None:
+        if target is None:
+            constants = calculate_platform_constants()
+        elif target in TARGETS:
+            constants = calculate_constants(*TARGETS[target])
+        else:
+            raise UnsupportedPlatform("Unsupported target %s" % target)
+        _CONSTANTS[target] = constants
+    return constants
+
+
+def __getattr__(name):
+    if name == "PLATFORM_CONSTANTS":
+        return target_constants()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,186 @@
+import hashlib
+import marshal
+
+from . import core, exceptions, tokens
+
+FORMAT_VERSION = 2
+MAGIC = b"SCPP"
+
+
+def _dump_tokens(value):
+    if value is core.UNDEFINED:
+        return None
+    return [(token.value, token.line_no, token.kind) for token in value]
+
+
+def _load_tokens(value):
+    if value is None:
+        return core.UNDEFINED
+    return [tokens.Token(line_no, token_value,
+                         kind in tokens.WHITESPACE_KINDS, kind)
+            for token_value, line_no, kind in value]
+
+
+def _dump_guard(item):
+    if item is core.Tag.PRAGMA_ONCE:
+        return item.value
+    constraint, constraint_type = item
+    return constraint, constraint_type.value
+
+
+def _load_guard(item):
+    if isinstance(item, str):
+        return core.Tag(item)
+    constraint, constraint_type = item
+    return constraint, core.Tag(constraint_type)
+
+
+def _constants_digest(defines):
+    """
+    Digest of the constants a Preprocessor started from, ie the layers of
+    its defines without the writes made while preprocessing.
+    """
+    constants = core.Defines(*defines.layers).items()
+    text = repr(sorted((name, "".join(token.value for token in value))
+                       for name, value in constants))
+    return hashlib.sha256(text.encode("utf-8", "surrogateescape")).hexdigest()
+
+
+class Prelude(object):
+    """
+    State of a Preprocessor after preprocessing a prelude header: the
+    defines it made, its include guards, resolved includes and optionally
+    its output. Applying it to a new Preprocessor is equivalent to having
+    preprocessed the prelude with it, provided the headers and options are
+    the same. The target and constants it was built with are checked when
+    it's applied.
+    """
+
+    def __init__(self, line_ending, defines, include_once, resolved,
+                 includes, output=None, target=None, constants=None):
+        self.line_ending = line_ending
+        self.target = target
+        self.constants = constants
+        self.defines = defines
+        self.include_once = include_once
+        self.resolved = resolved
+        self.includes = includes
+        self.output = output
+
+    @classmethod
+    def from_preprocessor(cls, preprocessor, output=None, target=None):
+        return cls(preprocessor.line_ending, dict(preprocessor.defines.delta),
+                   dict(preprocessor.include_once),
+                   dict(preprocessor.headers.resolved),
+                   list(preprocessor.includes), output, target,
+                   _constants_digest(preprocessor.defines))
+
+    def apply(self, preprocessor, target=None):
+        if preprocessor.line_ending != self.line_ending:
+            fmt = "Prelude was built for line ending %r, got %r"
+            raise exceptions.ParseError(fmt % (self.line_ending,
+                                               preprocessor.line_ending))
+        if target != self.target:
+            fmt = "Prelude was built for target %s, got %s"
+            raise exceptions.ParseError(fmt % (self.target or "host",
+                                               target or "host"))
+        if _constants_digest(preprocessor.defines) != self.constants:
+            raise exceptions.ParseError(
+                "Prelude was built with different constants")
+        for key, value in self.defines.items():
+            if value is core.UNDEFINED:
+                del preprocessor.defines[key]
+            else:
+                preprocessor.defines[key] = value
+        preprocessor.include_once.update(self.include_once)
+        for key, header_path in self.resolved.items():
+            preprocessor.headers.resolved.setdefault(key, header_path)
+        preprocessor.includes.extend(self.includes)
+
+    def dumps(self):
+        state = (self.line_ending,
+                 {key: _dump_tokens(value)
+                  for key, value in self.defines.items()},
+                 {name: _dump_guard(item)
+                  for name, item in self.include_once.items()},
+                 self.resolved, self.includes, self.output, self.target,
+                 self.constants)
+        return MAGIC + bytes([FORMAT_VERSION]) + marshal.dumps(state)
+
+    @classmethod
+    def loads(cls, data):
+        if data[:len(MAGIC)] != MAGIC:
+            raise exceptions.ParseError("Not a prelude file")
+        if len(data) <= len(MAGIC):
+            raise exceptions.ParseError("Truncated prelude file")
+        version = data[len(MAGIC)]
+        if version != FORMAT_VERSION:
+            fmt = "Unsupported prelude format version %s, expected %s"
+            raise exceptions.ParseError(fmt % (version, FORMAT_VERSION))
+        try:
+            (line_ending, defines, include_once, resolved, includes,
+             output, target, constants) = marshal.loads(data[len(MAGIC) + 1:])
+        except (EOFError, ValueError, TypeError):
+            raise exceptions.ParseError("Corrupted prelude file")
+        return cls(line_ending,
+                   {key: _load_tokens(value)
+                    for key, value in defines.items()},
+                   {name: _load_guard(item)
+                    for name, item in include_once.items()},
+                   resolved, [tuple(pair) for pair in includes], output,
+                   target, constants)
+
+
+def dump(prelude, f):
+    f.write(prelude.dumps())
+
+
+def load(f):
+    return Prelude.loads(f.read())
+
+
+def build(f_object, line_ending="\n", include_paths=(), header_handler=None,
+          extra_constants=(), ignore_headers=(), fold_strings_to_null=False,
+          tokenizer_class=tokens.Tokenizer, keep_output=False, target=None):
+    """
+    Preprocesses the prelude f_object and returns its Prelude. The
+    output of the prelude is kept in the Prelude if keep_output is set.
+    target selects the platform constants like in core.preprocess.
+    """
+    preprocessor = core.Preprocessor(line_ending, include_paths,
+                                     header_handler,
+                                     core.predefine(extra_constants, target),
+                                     ignore_headers, fold_strings_to_null,
+                                     tokenizer_class=tokenizer_class,
+                                     emit_source=keep_output)
+    output = "".join(preprocessor.preprocess(f_object))
+    return Prelude.from_preprocessor(preprocessor,
+                                     output if keep_output else None, target)
+
+
+def _run(prelude, preprocessor, f_object):
+    if prelude.output is not None:
+        yield prelude.output
+    for chunk in preprocessor.preprocess(f_object):
+        yield chunk
+
+
+def preprocess(f_object, prelude, line_ending="\n", include_paths=(),
+               header_handler=None, extra_constants=(), ignore_headers=(),
+               fold_strings_to_null=False, token_cache=None,
+               tokenizer_class=tokens.Tokenizer, max_expansion_depth=None,
+               max_expansions=None, target=None):
+    """
+    Same as core.preprocess but starts from the state left by prelude, as
+    if f_object was included after the prelude. The output of the prelude
+    comes first if it was kept. ParseError is raised if the prelude was
+    built for another line ending, target or extra_constants.
+    """
+    preprocessor = core.Preprocessor(line_ending, include_paths,
+                                     header_handler,
+                                     core.predefine(extra_constants, target),
+                                     ignore_headers, fold_strings_to_null,
+                                     token_cache, tokenizer_class,
+                                     max_expansion_depth, max_expansions)
+    prelude.apply(preprocessor, target)
+    return _run(prelude, preprocessor, f_object)
@@ -0,0 +1,58 @@
+from . import core, filesystem, tokens
+
+
+class PreprocessorSession(object):
+    """
+    Preprocesses many inputs in sequence. Include resolution, header
+    contents, tokenized headers and converted constants are kept between
+    runs while conditionals, include guards and defines made by the
+    previous input are reset for each run. Headers are assumed to stay
+    unchanged until clear is called.
+    """
+
+    def __init__(self, line_ending=tokens.DEFAULT_LINE_ENDING,
+                 include_paths=(), header_handler=None, extra_constants=(),
+                 ignore_headers=(), fold_strings_to_null=False,
+                 tokenizer_class=tokens.Tokenizer,
+                 max_expansion_depth=None, max_expansions=None,
+                 target=None):
+        if header_handler is None:
+            header_handler = filesystem.HeaderHandler(include_paths,
+                                                      cache_contents=True)
+        else:
+            header_handler.add_include_paths(include_paths)
+            if header_handler.contents is None:
+                header_handler.contents = {}
+        self.headers = header_handler
+        self.line_ending = line_ending
+        self.defines = core.predefine(extra_constants, target)
+        self.ignore_headers = ignore_headers
+        self.fold_strings_to_null = fold_strings_to_null
+        self.tokenizer_class = tokenizer_class
+        self.max_expansion_depth = max_expansion_depth
+        self.max_expansions = max_expansions
+        self.tokens = {}
+
+    def clear(self):
+        self.headers.resolved.clear()
+        self.headers.contents.clear()
+        self.tokens.clear()
+
+    def read_chunks(self, f_object, line_ending, tokenizer_class):
+        name = getattr(f_object, "name", None)
+        if self.headers.contents.get(name) is not f_object:
+            return tokenizer_class(f_object, line_ending).read_chunks()
+        chunks = self.tokens.get(name)
+        if chunks is None:
+            tokenizer = tokenizer_class(f_object, line_ending)
+            chunks = self.tokens[name] = list(tokenizer.read_chunks())
+        return chunks
+
+    def preprocess(self, f_object):
+        preprocessor = core.Preprocessor(self.line_ending, (), self.headers,
+                                         self.defines, self.ignore_headers,
+                                         self.fold_strings_to_null, self,
+                                         self.tokenizer_class,
+                                         self.max_expansion_depth,
+                                         self.max_expansions)
+        return preprocessor.preprocess(f_object)
@@ -0,0 +1,92 @@
+import time
+
+
+class HeaderStats(object):
+    """
+    Counters for one header, summed over every time it was opened. time
+    includes the headers it includes, self_time doesn't.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.opened = 0
+        self.time = 0.0
+        self.self_time = 0.0
+        self.lines = 0
+        self.tokens_lexed = 0
+        self.tokens_emitted = 0
+        self.directives = {}
+        self.expansions = 0
+        self.expansion_depth = 0
+        self.resolution_attempts = 0
+        self.skip_file_hits = 0
+
+    def as_dict(self):
+        return {"name": self.name,
+                "opened": self.opened,
+                "time": self.time,
+                "self_time": self.self_time,
+                "lines": self.lines,
+                "tokens_lexed": self.tokens_lexed,
+                "tokens_emitted": self.tokens_emitted,
+                "directives": dict(sorted(self.directives.items())),
+                "expansions": self.expansions,
+                "expansion_depth": self.expansion_depth,
+                "resolution_attempts": self.resolution_attempts,
+                "skip_file_hits": self.skip_file_hits}
+
+
+class Stats(object):
+    """
+    Collects HeaderStats for every file preprocessed when passed to a
+    Preprocessor as stats. Timing is wall time between opening and
+    closing each file, so it includes the time the consumer of the output
+    spends between chunks. Subclasses may override enter_header and
+    exit_header to get notified as files are opened and closed.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.headers = {}
+        self.stack = []
+
+    @property
+    def current(self):
+        return self.stack[-1][0]
+
+    def enter_header(self, name):
+        now = self.clock()
+        if self.stack:
+            parent = self.stack[-1]
+            parent[0].self_time += now - parent[2]
+        header = self.headers.get(name)
+        if header is None:
+            header = self.headers[name] = HeaderStats(name)
+        header.opened += 1
+        self.stack.append([header, now, now])
+        return header
+
+    def exit_header(self, lines):
+        now = self.clock()
+        header, started, resumed = self.stack.pop()
+        header.time += now - started
+        header.self_time += now - resumed
+        header.lines += lines
+        if self.stack:
+            self.stack[-1][2] = now
+
+    def as_dict(self):
+        headers = [header.as_dict() for header in self.headers.values()]
+        totals = {}
+        directives = {}
+        for header in headers:
+            for key, value in header.items():
+                if key == "directives":
+                    for name, count in value.items():
+                        directives[name] = directives.get(name, 0) + count
+                elif key == "expansion_depth":
+                    totals[key] = max(totals.get(key, 0), value)
+                elif key not in ("name", "time"):
+                    totals[key] = totals.get(key, 0) + value
+        totals["directives"] = dict(sorted(directives.items()))
+        return {"headers": headers, "totals": totals}
@@ -1,17 +1,34 @@
 from __future__ import absolute_import
 import pytest
 import ntpath
-from simplecpreprocessor import preprocess
-from simplecpreprocessor.core import Preprocessor
+from simplecpreprocessor import (preprocess, preprocess_async,
+                                 preprocess_bytes, preprocess_many,
+                                 preprocess_to_file, preprocess_to_string,
+                                 PreprocessorSession)
+from simplecpreprocessor.__main__ import main
+from simplecpreprocessor.core import Defines, Preprocessor, predefine
 from simplecpreprocessor.exceptions import ParseError, UnsupportedPlatform
 from simplecpreprocessor.platform import (calculate_platform_constants,
                                           extract_platform_spec)
-from simplecpreprocessor.filesystem import FakeFile, FakeHandler
+from simplecpreprocessor.filesystem import (FakeFile, FakeHandler,
+                                            HeaderHandler)
+from simplecpreprocessor.cache import HEADER, ResultCache, TokenCache
+from simplecpreprocessor import (aio, batch, benchmark, depends,
+                                 filesystem, prelude, stats)
+from simplecpreprocessor.tokens import BufferTokenizer, Tokenizer
+from simplecpreprocessor import tokens
+import asyncio
+import concurrent.futures
 import posixpath
 import os
 import cProfile
 from pstats import Stats
 import platform
+import json
+import io
+import codecs
+import locale
+import marshal
 import mock
 
 profiler = None
@@ -720,3 +737,1108 @@ def test_platform():
     system = platform.system()
     bitness, _ = platform.architecture()
     assert extract_platform_spec() == (system, bitness)
+
+
+def test_token_cache_reuses_tokens(tmp_path):
+    header = tmp_path / "other.h"
+    header.write_text("#define FOO 1 /* comment */\nFOO \\\n 2\n")
+    cache = TokenCache(str(tmp_path / "cache"))
+    f_obj = FakeFile("header.h", ["#include <other.h>\n"])
+    ret = preprocess(f_obj, include_paths=[str(tmp_path)],
+                     token_cache=cache)
+    assert "".join(ret) == "1 \\\n 2\n"
+    # one entry for the header on disk, one for the in-memory input
+    assert len(os.listdir(str(tmp_path / "cache"))) == 2
+    read_chunks = Tokenizer.read_chunks
+    with mock.patch.object(Tokenizer, "read_chunks", autospec=True,
+                           side_effect=read_chunks) as mock_read:
+        ret = preprocess(f_obj, include_paths=[str(tmp_path)],
+                         token_cache=cache)
+        assert "".join(ret) == "1 \\\n 2\n"
+        assert mock_read.call_count == 0
+
+
+def test_token_cache_invalidated_on_change(tmp_path):
+    header = tmp_path / "other.h"
+    header.write_text("1\n")
+    cache = TokenCache(str(tmp_path / "cache"))
+    f_obj = FakeFile("header.h", ["#include <other.h>\n"])
+    ret = preprocess(f_obj, include_paths=[str(tmp_path)],
+                     token_cache=cache)
+    assert "".join(ret) == "1\n"
+    header.write_text("22\n")
+    ret = preprocess(f_obj, include_paths=[str(tmp_path)],
+                     token_cache=cache)
+    assert "".join(ret) == "22\n"
+
+
+def test_token_cache_ignores_stale_cached_contents(tmp_path):
+    header = tmp_path / "other.h"
+    header.write_text("old\n")
+    cache = TokenCache(str(tmp_path / "cache"))
+    handler = HeaderHandler([str(tmp_path)], cache_contents=True)
+    f_obj = FakeFile("header.h", ["#include <other.h>\n"])
+    "".join(preprocess(f_obj, header_handler=handler))
+    header.write_text("newer\n")
+    ret = preprocess(f_obj, header_handler=handler, token_cache=cache)
+    assert "".join(ret) == "old\n"
+    ret = preprocess(f_obj, include_paths=[str(tmp_path)],
+                     token_cache=cache)
+    assert "".join(ret) == "newer\n"
+
+
+def test_token_cache_ignores_corrupt_entry(tmp_path):
+    header = tmp_path / "other.h"
+    header.write_text("1\n")
+    cache_dir = tmp_path / "cache"
+    cache = TokenCache(str(cache_dir))
+    f_obj = FakeFile("header.h", ["#include <other.h>\n"])
+    "".join(preprocess(f_obj, include_paths=[str(tmp_path)],
+                       token_cache=cache))
+    for entry in cache_dir.iterdir():
+        entry.write_bytes(b"garbage")
+    ret = preprocess(f_obj, include_paths=[str(tmp_path)],
+                     token_cache=cache)
+    assert "".join(ret) == "1\n"
+
+
+def test_token_cache_ignores_corrupt_payload(tmp_path):
+    header = tmp_path / "other.h"
+    header.write_text("1\n")
+    info = os.stat(str(header))
+    cache_dir = tmp_path / "cache"
+    cache = TokenCache(str(cache_dir))
+    f_obj = FakeFile("header.h", ["#include <other.h>\n"])
+    "".join(preprocess(f_obj, include_paths=[str(tmp_path)],
+                       token_cache=cache))
+    stamp = (info.st_mtime_ns, info.st_size)
+    for entry in cache_dir.iterdir():
+        entry.write_bytes(HEADER + marshal.dumps((stamp, b"garbage")))
+    ret = preprocess(f_obj, include_paths=[str(tmp_path)],
+                     token_cache=cache)
+    assert "".join(ret) == "1\n"
+
+
+def test_result_cache_hit(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    handler = FakeHandler({"other.h": ["#define X 1\n"]})
+    f_obj = FakeFile("header.h", ['#include "other.h"\n', "X\n"])
+    ret = cache.preprocess(f_obj, header_handler=handler)
+    assert "".join(ret) == "1\n"
+    with mock.patch.object(Tokenizer, "read_chunks") as mock_read:
+        ret = cache.preprocess(f_obj, header_handler=handler)
+        assert "".join(ret) == "1\n"
+        assert not mock_read.called
+
+
+def test_result_cache_keyed_by_input_directory(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    for directory in ("a", "b"):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / "shim.h").write_text(
+            '#include "config.h"\n')
+        (tmp_path / directory / "config.h").write_text(
+            directory.upper() + "\n")
+    for _ in range(2):
+        for directory in ("a", "b"):
+            with open(str(tmp_path / directory / "shim.h")) as f_obj:
+                ret = "".join(cache.preprocess(f_obj))
+            assert ret == directory.upper() + "\n"
+
+
+def test_result_cache_header_changed(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    mapping = {"other.h": ["#define X 1\n"]}
+    handler = FakeHandler(mapping)
+    f_obj = FakeFile("header.h", ['#include "other.h"\n', "X\n"])
+    assert "".join(cache.preprocess(f_obj, header_handler=handler)) == "1\n"
+    mapping["other.h"] = ["#define X 2\n"]
+    assert "".join(cache.preprocess(f_obj, header_handler=handler)) == "2\n"
+
+
+def test_result_cache_stores_preprocessed_contents(tmp_path):
+    inc = tmp_path / "inc"
+    inc.mkdir()
+    (inc / "h.h").write_text("old\n")
+    cache = ResultCache(str(tmp_path / "cache"))
+    handler = HeaderHandler([str(inc)], cache_contents=True)
+    f_obj = FakeFile("header.h", ["#include <h.h>\n"])
+    "".join(preprocess(f_obj, header_handler=handler))
+    (inc / "h.h").write_text("newer\n")
+    ret = cache.preprocess(f_obj, header_handler=handler)
+    assert "".join(ret) == "old\n"
+    ret = cache.preprocess(f_obj, include_paths=[str(inc)])
+    assert "".join(ret) == "newer\n"
+
+
+def test_result_cache_options_in_key(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    f_obj = FakeFile("header.h", ['"foo" X\n'])
+    assert "".join(cache.preprocess(f_obj)) == '"foo" X\n'
+    ret = cache.preprocess(f_obj, fold_strings_to_null=True)
+    assert "".join(ret) == "NULL X\n"
+    ret = cache.preprocess(f_obj, extra_constants={"X": "1"})
+    assert "".join(ret) == '"foo" 1\n'
+    assert len(os.listdir(str(tmp_path))) == 3
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    inputs = [FakeFile("header.h", ["%s\n" % name]) for name in "abc"]
+    for age, f_obj in enumerate(inputs[:2]):
+        "".join(cache.preprocess(f_obj))
+        for entry in os.scandir(str(tmp_path)):
+            if entry.stat().st_mtime_ns > 10 ** 9:
+                os.utime(entry.path, ns=(age, age))
+    sizes = [entry.stat().st_size for entry in os.scandir(str(tmp_path))]
+    cache.max_size = sum(sizes)
+    assert "".join(cache.preprocess(inputs[0])) == "a\n"
+    "".join(cache.preprocess(inputs[2]))
+    assert len(os.listdir(str(tmp_path))) == 2
+    with mock.patch.object(Tokenizer, "read_chunks") as mock_read:
+        assert "".join(cache.preprocess(inputs[0])) == "a\n"
+        assert not mock_read.called
+
+
+def write_batch_inputs(tmp_path):
+    include_dir = tmp_path / "include"
+    include_dir.mkdir()
+    (include_dir / "common.h").write_text("#define VALUE 1\n")
+    inputs = []
+    for i in range(3):
+        path = tmp_path / ("shim%d.h" % i)
+        path.write_text("#include <common.h>\nVALUE + %d\n" % i)
+        inputs.append(str(path))
+    broken = tmp_path / "broken.h"
+    broken.write_text("#include <missing.h>\n")
+    inputs.append(str(broken))
+    return str(include_dir), inputs
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_preprocess_many(tmp_path, workers):
+    include_dir, inputs = write_batch_inputs(tmp_path)
+    results = preprocess_many(inputs, workers=workers,
+                              include_paths=[include_dir])
+    assert [r.input_file for r in results] == inputs
+    assert [r.output for r in results] == ["1 + 0\n", "1 + 1\n",
+                                           "1 + 2\n", None]
+    assert [r.error is None for r in results] == [True, True, True, False]
+    assert "missing.h" in results[-1].error
+
+
+@pytest.mark.skipif(codecs.lookup(locale.getpreferredencoding(False)).name
+                    != "utf-8", reason="needs a UTF-8 locale")
+@pytest.mark.parametrize("workers", [1, 2])
+def test_preprocess_many_failed_jobs(tmp_path, workers):
+    undecodable = tmp_path / "undecodable.h"
+    undecodable.write_bytes(b"caf\xe9\n")
+    truncated = tmp_path / "truncated.h"
+    truncated.write_text("x\n" * 10000 + "#include <missing.h>\n")
+    valid = tmp_path / "valid.h"
+    valid.write_text("#define FOO 1\nFOO\n")
+    jobs = [(str(path), str(path) + ".out")
+            for path in (undecodable, truncated, valid)]
+    results = preprocess_many(jobs, workers=workers)
+    assert [r.error is None for r in results] == [False, False, True]
+    assert (tmp_path / "valid.h.out").read_text() == "1\n"
+    assert sorted(os.listdir(str(tmp_path))) == ["truncated.h",
+                                                 "undecodable.h", "valid.h",
+                                                 "valid.h.out"]
+
+
+def write_shims_with_local_config(tmp_path):
+    inputs = []
+    for name in ("a", "b"):
+        directory = tmp_path / name
+        directory.mkdir()
+        (directory / "config.h").write_text("%s\n" % name)
+        (directory / "shim.h").write_text('#include "config.h"\n')
+        inputs.append(str(directory / "shim.h"))
+    return inputs
+
+
+def test_preprocess_many_quoted_includes_per_directory(tmp_path):
+    inputs = write_shims_with_local_config(tmp_path)
+    results = preprocess_many(inputs, workers=1)
+    assert [r.output for r in results] == ["a\n", "b\n"]
+
+
+def test_main_manifest(tmp_path, capsys):
+    include_dir, inputs = write_batch_inputs(tmp_path)
+    jobs = [{"input": path, "output": path + ".out"} for path in inputs]
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps(jobs))
+    with pytest.raises(SystemExit):
+        main(["--manifest", str(manifest), "--include-path", include_dir,
+              "--jobs", "2"])
+    with open(inputs[1] + ".out") as f:
+        assert f.read() == "1 + 1\n"
+    assert "broken.h" in capsys.readouterr().err
+
+
+def test_preprocess_to_string():
+    f_obj = FakeFile("header.h", ["#define FOO 1\n", "FOO\n"])
+    assert preprocess_to_string(f_obj, line_ending="\r\n") == "1\r\n"
+
+
+def test_preprocess_to_file():
+    f_obj = FakeFile("header.h", ["#define FOO 1\n", "FOO + 2\n", "3\n"])
+    f_out = mock.Mock(wraps=io.StringIO())
+    preprocess_to_file(f_obj, f_out, buffer_size=4)
+    assert f_out.getvalue() == "1 + 2\n3\n"
+    assert f_out.write.call_count == 2
+
+
+def test_main(tmp_path):
+    input_file = tmp_path / "input.h"
+    input_file.write_text("#define FOO 1\nFOO\n")
+    output_file = tmp_path / "output.h"
+    main(["--input-file", str(input_file),
+          "--output-file", str(output_file)])
+    assert output_file.read_text() == "1\n"
+
+
+@pytest.mark.parametrize("source", [
+    "#define FOO 1 /* comment */\nFOO\n",
+    "#define FOO \\\n\t1\nFOO",
+    " /* \n 'foo */\n  #ifdef X // comment\n#endif\n",
+    "foo\r\nbar \\\r\n",
+    "a /* b */ c // d \\\n e\n\n",
+    "x /* unterminated",
+    "",
+])
+def test_buffer_tokenizer_matches_tokenizer(source):
+    def dump(tokenizer):
+        return [[(t.value, t.line_no, t.whitespace) for t in chunk]
+                for chunk in tokenizer.read_chunks()]
+    lines = list(io.StringIO(source, newline=""))
+    buffered = BufferTokenizer(io.StringIO(source, newline=""), "\n")
+    assert dump(buffered) == dump(Tokenizer(lines, "\n"))
+
+
+def test_buffer_tokenizer_preprocess():
+    f_obj = FakeFile("header.h", ["#define FOO 1\n", "FOO\n"])
+    ret = preprocess(f_obj, tokenizer_class=BufferTokenizer)
+    assert "".join(ret) == "1\n"
+
+
+def test_token_kinds():
+    f_obj = FakeFile("header.h", ['#include <a.h> x "s" \'c\' // c\n'])
+    chunk, = Tokenizer(f_obj, "\n").read_chunks()
+    assert [(t.value, t.kind) for t in chunk] == [
+        ("#", tokens.PUNCTUATION),
+        ("include", tokens.IDENTIFIER),
+        (" ", tokens.WHITESPACE),
+        ("<a.h>", tokens.HEADER_NAME),
+        (" ", tokens.WHITESPACE),
+        ("x", tokens.IDENTIFIER),
+        (" ", tokens.WHITESPACE),
+        ('"s"', tokens.STRING),
+        (" ", tokens.WHITESPACE),
+        ("'c'", tokens.CHARACTER),
+        ("\n", tokens.NEWLINE),
+    ]
+
+
+def test_string_folding_from_define():
+    f_obj = FakeFile("header.h", ['#define S "meep"\n', 'S\n'])
+    ret = preprocess(f_obj, fold_strings_to_null=True,
+                     extra_constants={"T": '"x"'})
+    assert "".join(ret) == "NULL\n"
+    f_obj = FakeFile("header.h", ['T\n'])
+    ret = preprocess(f_obj, fold_strings_to_null=True,
+                     extra_constants={"T": '"x"'})
+    assert "".join(ret) == "NULL\n"
+
+
+def test_register_pragma():
+    def process_pragma_warning(preprocessor, chunk, line_no):
+        yield "/* warning on line %s */" % line_no
+
+    f_obj = FakeFile("header.h", ["#pragma warning(disable: 4996)\n",
+                                  "1\n"])
+    preprocessor = Preprocessor()
+    preprocessor.register_pragma("warning", process_pragma_warning)
+    assert "".join(preprocessor.preprocess(f_obj)) == (
+        "/* warning on line 0 */1\n")
+    assert "warning" not in Preprocessor.pragmas
+
+
+def test_register_directive():
+    def process_error(preprocessor, chunk, line_no):
+        raise ParseError("error directive on line %s" % line_no)
+
+    f_obj = FakeFile("header.h", ["#error bad\n"])
+    preprocessor = Preprocessor()
+    preprocessor.register_directive("error", process_error)
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocessor.preprocess(f_obj))
+    assert "error directive on line 0" in str(excinfo.value)
+    assert "error" not in Preprocessor.directives
+
+
+def test_subclass_directive_override():
+    class CustomPreprocessor(Preprocessor):
+        def process_undef(self, **kwargs):
+            pass
+
+        def process_pragma_custom(self, **kwargs):
+            yield "custom"
+
+    f_obj = FakeFile("header.h", ["#define FOO 1\n",
+                                  "#undef FOO\n",
+                                  "#pragma custom\n",
+                                  "FOO\n"])
+    ret = CustomPreprocessor().preprocess(f_obj)
+    assert "".join(ret) == "custom1\n"
+
+
+def test_defines_layers():
+    base = {"A": 1, "B": 2}
+    defines = Defines(base)
+    defines["C"] = 3
+    del defines["A"]
+    assert "A" not in defines
+    assert defines.get("B") == 2
+    assert base == {"A": 1, "B": 2}
+    fork = defines.fork()
+    fork["B"] = 4
+    del fork["C"]
+    assert defines.get("B") == 2
+    assert defines.get("C") == 3
+    assert fork.get("B") == 4
+    assert "C" not in fork
+    assert sorted(fork.items()) == [("B", 4)]
+
+
+def test_defines_snapshot_restore():
+    defines = Defines({"A": 1})
+    snapshot = defines.snapshot()
+    defines["A"] = 2
+    defines["B"] = 3
+    defines.restore(snapshot)
+    assert defines.get("A") == 1
+    assert "B" not in defines
+
+
+def test_defines_collapse_layers():
+    defines = Defines({"A": 1})
+    for i in range(Defines.MAX_LAYERS + 1):
+        defines[str(i)] = i
+        del defines["A"]
+        defines = defines.fork()
+    assert len(defines.layers) <= Defines.MAX_LAYERS
+    assert "A" not in defines
+    assert defines.get("0") == 0
+
+
+def test_predefine_reused():
+    constants = predefine({"FOO": "1"})
+    for _ in range(2):
+        f_obj = FakeFile("header.h", ["FOO\n", "#define FOO 2\n", "FOO\n",
+                                      "__SIZE_TYPE__\n"])
+        ret = preprocess(f_obj, extra_constants=constants)
+        assert "".join(ret) == "1\n2\nsize_t\n"
+
+
+def test_session_shares_headers():
+    mapping = {"include/common.h": ["#pragma once\n",
+                                    "#define VALUE 1\n",
+                                    "VALUE\n"]}
+    handler = FakeHandler(mapping, include_paths=["include"])
+    session = PreprocessorSession(header_handler=handler)
+    read_chunks = Tokenizer.read_chunks
+    with mock.patch.object(Tokenizer, "read_chunks", autospec=True,
+                           side_effect=read_chunks) as mock_read:
+        for i in range(3):
+            f_obj = FakeFile("shim.h", ["#include <common.h>\n",
+                                        "#include <common.h>\n",
+                                        "#define LOCAL %d\n" % i,
+                                        "LOCAL VALUE\n"])
+            ret = session.preprocess(f_obj)
+            assert "".join(ret) == "1\n%d 1\n" % i
+        assert mock_read.call_count == 4
+    del mapping["include/common.h"]
+    f_obj = FakeFile("shim.h", ["#include <common.h>\n", "LOCAL\n"])
+    assert "".join(session.preprocess(f_obj)) == "1\nLOCAL\n"
+    session.clear()
+    with pytest.raises(ParseError):
+        "".join(session.preprocess(f_obj))
+
+
+def test_session_contents_cache(tmp_path):
+    (tmp_path / "other.h").write_text("1\n")
+    session = PreprocessorSession(include_paths=[str(tmp_path)])
+    f_obj = FakeFile("shim.h", ["#include <other.h>\n"])
+    assert "".join(session.preprocess(f_obj)) == "1\n"
+    (tmp_path / "other.h").write_text("2\n")
+    assert "".join(session.preprocess(f_obj)) == "1\n"
+
+
+def test_session_quoted_includes_per_directory(tmp_path):
+    session = PreprocessorSession()
+    outputs = []
+    for input_file in write_shims_with_local_config(tmp_path):
+        with open(input_file) as f_obj:
+            outputs.append("".join(session.preprocess(f_obj)))
+    assert outputs == ["a\n", "b\n"]
+
+
+def test_expansion_memo_invalidation():
+    f_obj = FakeFile("header.h", ["#define A B + C\n",
+                                  "#define B 1\n",
+                                  "A\n",
+                                  "#define B 2\n",
+                                  "A\n",
+                                  "#undef B\n",
+                                  "A\n",
+                                  "#define C B\n",
+                                  "A\n",
+                                  "B C\n"])
+    expected = "1 + C\n2 + C\nB + C\nB + B\nB B\n"
+    run_case(f_obj, expected)
+
+
+def test_expansion_memo_reused():
+    f_obj = FakeFile("header.h", ["#define A B\n",
+                                  "#define B 1\n",
+                                  "A A\n"])
+    preprocessor = Preprocessor()
+    assert "".join(preprocessor.preprocess(f_obj)) == "1 1\n"
+    expansion = preprocessor.defines.expansion("A")
+    assert [token.value for token in expansion.tokens] == ["1"]
+    assert expansion.dependencies == {"A", "B", "1"}
+    assert expansion.cost == 2
+    assert expansion.depth == 2
+
+
+def test_expansion_depth_limit():
+    lines = ["#define M%d M%d\n" % (i, i + 1) for i in range(10)]
+    f_obj = FakeFile("header.h", lines + ["M5\n", "M0\n"])
+    preprocessor = Preprocessor()
+    preprocessor.token_expander.max_depth = 5
+    ret = preprocessor.preprocess(f_obj)
+    assert next(ret) == "M10"
+    with pytest.raises(ParseError) as excinfo:
+        "".join(ret)
+    assert "M0 on line 11 exceeds depth limit 5" in str(excinfo.value)
+
+
+def test_expansion_budget():
+    lines = ["#define A0 x\n"]
+    lines += ["#define A%d A%d A%d\n" % (i + 1, i, i) for i in range(20)]
+    f_obj = FakeFile("header.h", lines + ["A3\n", "A20\n"])
+    ret = preprocess(f_obj, max_expansions=100)
+    assert next(ret) == "x"
+    with pytest.raises(ParseError) as excinfo:
+        "".join(ret)
+    assert "exceeds expansion budget 100" in str(excinfo.value)
+
+
+def test_deep_expansion_chain():
+    lines = ["#define M%d M%d\n" % (i, i + 1) for i in range(5000)]
+    f_obj = FakeFile("header.h", lines + ["M0\n"])
+    run_case(f_obj, "M5000\n")
+
+
+@pytest.mark.parametrize("tokenizer_class", [Tokenizer, BufferTokenizer])
+def test_tokenizer_skip(tokenizer_class):
+    source = ["int a;\n",
+              "  #endif\n",
+              "/* x\n",
+              "#endif */ b \\\n",
+              "#endif\n",
+              "c // d\n",
+              "e"]
+    tokenizer = tokenizer_class(FakeFile("header.h", source), "\n",
+                                lambda: True)
+    chunks = ["".join(t.value for t in chunk)
+              for chunk in tokenizer.read_chunks()]
+    assert chunks == ["#endif\n", " b \\\n#endif\n", "e"]
+    assert tokenizer.skipped_lines == 2
+
+
+@pytest.mark.parametrize("tokenizer_class", [Tokenizer, BufferTokenizer])
+def test_skip_inactive_region(tokenizer_class):
+    f_obj = FakeFile("header.h", ["#ifdef X\n",
+                                  "int a;\n",
+                                  "/* #endif\n",
+                                  "*/\n",
+                                  "#include <missing.h>\n",
+                                  "#pragma bogus\n",
+                                  "#else\n",
+                                  "int b;\n",
+                                  "#endif\n"])
+    ret = preprocess(f_obj, tokenizer_class=tokenizer_class)
+    assert "".join(ret) == "int b;\n"
+
+
+def test_pragma_once_in_inactive_region():
+    f_obj = FakeFile("header.h", ["#ifdef X\n",
+                                  '#include "other.h"\n',
+                                  "#endif\n",
+                                  '#include "other.h"\n'])
+    handler = FakeHandler({"other.h": ["#pragma once\n", "1\n"]})
+    ret = preprocess(f_obj, header_handler=handler)
+    assert "".join(ret) == "1\n"
+
+
+def test_find_dependencies():
+    f_obj = FakeFile("shim.h", ['#include "a.h"\n',
+                                "#ifdef B\n",
+                                '#include "b.h"\n',
+                                "#endif\n",
+                                '#include "a.h"\n',
+                                "#define C\n",
+                                '#include "c.h"\n'])
+    handler = FakeHandler({"a.h": ["#ifndef A\n", "#define A\n",
+                                   '#include "c.h"\n', "#endif\n"],
+                           "b.h": ["b\n"],
+                           "c.h": ["#ifndef C\n", "c\n", "#endif\n"]})
+    with mock.patch.object(Preprocessor, "process_source_chunks") as source:
+        includes = depends.find_dependencies(f_obj, header_handler=handler)
+        assert not source.called
+    assert includes == [("shim.h", "a.h"), ("a.h", "c.h")]
+    assert depends.format_makefile("out h", includes, "shim.h") == (
+        "out\\ h: \\\n  shim.h \\\n  a.h \\\n  c.h\n")
+    assert json.loads(depends.format_json("out", includes, "shim.h")) == {
+        "target": "out",
+        "source": "shim.h",
+        "dependencies": ["a.h", "c.h"],
+        "graph": [["shim.h", ["a.h"]], ["a.h", ["c.h"]]],
+    }
+
+
+def test_main_dependencies(tmp_path):
+    (tmp_path / "other.h").write_text("#define X\n")
+    input_file = tmp_path / "input.h"
+    input_file.write_text('#include "other.h"\nX\n')
+    output_file = tmp_path / "deps.mk"
+    main(["--input-file", str(input_file),
+          "--output-file", str(output_file),
+          "--dependencies", "make",
+          "--dependency-target", "out.h"])
+    assert output_file.read_text() == "out.h: \\\n  %s \\\n  %s\n" % (
+        input_file, tmp_path / "other.h")
+
+
+def test_directory_index_skips_missing_candidates():
+    include_paths = ["path%d" % i for i in range(5)]
+    handler = FakeHandler({"path4/other.h": ["1\n"]},
+                          include_paths=include_paths,
+                          index_directories=True)
+    f_obj = FakeFile("header.h", ["#include <other.h>\n",
+                                  "#include <nested/other.h>\n"])
+    with mock.patch.object(FakeHandler, "_open", autospec=True,
+                           side_effect=FakeHandler._open) as mock_open:
+        with pytest.raises(ParseError):
+            "".join(preprocess(f_obj, header_handler=handler))
+        assert [call[0][1] for call in mock_open.call_args_list] == [
+            "path4/other.h"]
+
+
+def test_directory_index_check_mtime(tmp_path):
+    f_obj = FakeFile("header.h", ["#include <other.h>\n"])
+    for check_mtime in (False, True):
+        directory = tmp_path / str(check_mtime)
+        directory.mkdir()
+        handler = HeaderHandler([str(directory)], index_directories=True,
+                                check_mtime=check_mtime)
+        with pytest.raises(ParseError):
+            "".join(preprocess(f_obj, header_handler=handler))
+        (directory / "other.h").write_text("1\n")
+        os.utime(str(directory), ns=(1, 1))
+        if check_mtime:
+            assert "".join(preprocess(f_obj, header_handler=handler)) == "1\n"
+        else:
+            with pytest.raises(ParseError):
+                "".join(preprocess(f_obj, header_handler=handler))
+
+
+def test_resolution_cache_keyed_by_anchor():
+    f_obj = FakeFile("header.h", ['#include "a/x.h"\n',
+                                  '#include "b/x.h"\n',
+                                  "#include <config.h>\n"])
+    resolved = {}
+    for _ in range(2):
+        handler = FakeHandler({"a/x.h": ['#include "config.h"\n'],
+                               "b/x.h": ['#include "config.h"\n'],
+                               "a/config.h": ["a\n"],
+                               "b/config.h": ["b\n"],
+                               "inc/config.h": ["inc\n"]},
+                              include_paths=["inc"], resolved=resolved)
+        ret = preprocess(f_obj, header_handler=handler)
+        assert "".join(ret) == "a\nb\ninc\n"
+    assert resolved[("a", "config.h")] == "a/config.h"
+    assert resolved[("b", "config.h")] == "b/config.h"
+    assert resolved["config.h"] == "inc/config.h"
+
+
+def _collect_async(iterator):
+    async def collect():
+        return [chunk async for chunk in iterator]
+    return asyncio.run(collect())
+
+
+def test_preprocess_async_memory_loader():
+    f_obj = FakeFile("header.h", ['#include "a/x.h"\n',
+                                  "#include <config.h>\n",
+                                  "#include <config.h>\n"])
+    loader = aio.MemoryLoader({"a/x.h": ['#include "y.h"\n'],
+                               "a/y.h": ["#pragma once\n", "y\n"],
+                               "inc/config.h": ["config\n"]})
+    with mock.patch.object(loader, "load", wraps=loader.load) as load:
+        chunks = _collect_async(preprocess_async(f_obj, loader,
+                                                 include_paths=["inc"]))
+    assert "".join(chunks) == "y\nconfig\nconfig\n"
+    assert sorted(call[0][0] for call in load.call_args_list) == [
+        "a/x.h", "a/y.h", "inc/config.h"]
+
+
+def test_preprocess_async_missing_header():
+    f_obj = FakeFile("header.h", ["#include <missing.h>\n"])
+    with pytest.raises(ParseError):
+        _collect_async(preprocess_async(f_obj, aio.MemoryLoader({})))
+
+
+def test_preprocess_async_directory_loader(tmp_path):
+    (tmp_path / "inc").mkdir()
+    (tmp_path / "inc" / "a.h").write_text("#define A 1\n")
+    f_obj = FakeFile("header.h", ["#include <a.h>\n", "A\n"])
+    chunks = _collect_async(preprocess_async(
+        f_obj, include_paths=[str(tmp_path / "inc")]))
+    assert "".join(chunks) == "1\n"
+
+
+def test_preprocess_async_interleaves():
+    f_obj = FakeFile("header.h", ["#include <a.h>\n"])
+    loader = aio.MemoryLoader({"inc/a.h": ["a\n"]})
+
+    async def run_all():
+        async def collect():
+            return "".join([chunk async for chunk in
+                            preprocess_async(f_obj, loader,
+                                             include_paths=["inc"])])
+        return await asyncio.gather(*(collect() for _ in range(5)))
+    assert asyncio.run(run_all()) == ["a\n"] * 5
+
+
+def test_prefetch_includes():
+    f_obj = FakeFile("header.h", ["#include <a.h>\n",
+                                  "#include <a.h>\n",
+                                  '#include "sub/d.h"\n'])
+    mapping = {"inc/a.h": ['#include "b.h"\n', "#ifdef NOT_DEFINED\n",
+                           "#include <c.h>\n", "#endif\n", "a\n"],
+               "inc/b.h": ["#pragma once\n", "#include <c.h>\n",
+                           "b\n"],
+               "inc/c.h": ["c\n"],
+               "sub/d.h": ['#include "e.h"\n'],
+               "sub/e.h": ["e\n"]}
+    expected = "".join(preprocess(f_obj, header_handler=FakeHandler(
+        mapping, include_paths=["inc"])))
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        handler = FakeHandler(mapping, include_paths=["inc"],
+                              executor=executor)
+        with mock.patch.object(FakeHandler, "_open", autospec=True,
+                               side_effect=FakeHandler._open) as mock_open:
+            ret = "".join(preprocess(f_obj, header_handler=handler))
+    assert ret == expected == "c\nb\na\na\ne\n"
+    opened = [call[0][1] for call in mock_open.call_args_list]
+    assert sorted(opened) == sorted(set(opened))
+    assert set(opened) == set(mapping)
+
+
+def test_pretokenize(tmp_path):
+    include_dir = tmp_path / "include"
+    include_dir.mkdir()
+    (include_dir / "a.h").write_text('#include "b.h"\n'
+                                     "#define A 1 // one\n")
+    (include_dir / "b.h").write_text("#pragma once\nb /* b */\n")
+    (include_dir / "c.h").write_text("#include <missing.h>\n")
+    input_file = tmp_path / "input.h"
+    input_file.write_text("#include <a.h>\n#include <ignored.h>\n"
+                          "#ifdef X\n#include <c.h>\n#endif\nA\n")
+    input_name = posixpath.join(tmp_path.as_posix(), "input.h")
+    include_path = include_dir.as_posix()
+    token_cache = batch.pretokenize(input_name, [include_path],
+                                    ignore_headers=["ignored.h"],
+                                    workers=2)
+    assert sorted(token_cache.serialized) == sorted(
+        (posixpath.join(include_path, name), "\n")
+        for name in ["a.h", "b.h", "c.h"]) + [(input_name, "\n")]
+    kwargs = {"include_paths": [include_path],
+              "ignore_headers": ["ignored.h"]}
+    with open(input_name) as f_obj:
+        expected = "".join(preprocess(f_obj, **kwargs))
+    with mock.patch.object(Tokenizer, "read_chunks", autospec=True,
+                           side_effect=Tokenizer.read_chunks) as read:
+        with open(input_name) as f_obj:
+            ret = "".join(preprocess(f_obj, token_cache=token_cache,
+                                     **kwargs))
+    assert ret == expected == "b\n1\n"
+    assert read.call_count == 0
+
+
+def test_main_pretokenize(tmp_path):
+    (tmp_path / "a.h").write_text("#define FOO 1\n")
+    input_file = tmp_path / "input.h"
+    input_file.write_text('#include "a.h"\nFOO\n')
+    output_file = tmp_path / "output.h"
+    with mock.patch("simplecpreprocessor.batch.pretokenize",
+                    wraps=batch.pretokenize) as pretokenize:
+        main(["--input-file", str(input_file),
+              "--output-file", str(output_file), "--jobs", "2"])
+    assert pretokenize.call_count == 1
+    assert output_file.read_text() == "1\n"
+
+
+def test_benchmark_corpora_preprocess():
+    for name, generator in benchmark.CORPORA.items():
+        corpus = generator()
+        handler = FakeHandler(corpus.headers, corpus.include_paths)
+        f_obj = FakeFile(corpus.input_name,
+                         corpus.headers[corpus.input_name])
+        assert "".join(preprocess(f_obj, header_handler=handler)), name
+
+
+def test_benchmark_compare(tmp_path):
+    results = benchmark.run_benchmarks(["macro_chains"], repeat=1)
+    assert sorted(results) == ["macro_chains/expander",
+                               "macro_chains/preprocess",
+                               "macro_chains/tokenizer"]
+    baseline_path = str(tmp_path / "baseline.json")
+    benchmark.save_baseline(results, baseline_path)
+    baseline = benchmark.load_baseline(baseline_path)
+    assert benchmark.compare(results, baseline) == []
+    slower = dict(results)
+    slower["macro_chains/tokenizer"] = dict(
+        results["macro_chains/tokenizer"],
+        lines_per_second=results["macro_chains/tokenizer"][
+            "lines_per_second"] / 2)
+    assert [r[:2] for r in benchmark.compare(slower, baseline)] == [
+        ("macro_chains/tokenizer", "lines_per_second")]
+
+
+def test_stats():
+    f_obj = FakeFile("header.h", ["#include <a.h>\n",
+                                  "#include <a.h>\n",
+                                  "#define B A + A\n",
+                                  "B\n"])
+    handler = FakeHandler({"inc/a.h": ["#ifndef A\n", "#define A 1\n",
+                                       "A\n", "#endif\n"]},
+                          include_paths=["other", "inc"])
+    ticks = iter(range(100))
+    collected = stats.Stats(clock=lambda: next(ticks))
+    ret = preprocess(f_obj, header_handler=handler, stats=collected)
+    assert "".join(ret) == "1\n1 + 1\n"
+    report = collected.as_dict()
+    header, a = report["headers"]
+    assert header["name"] == "header.h"
+    assert header["directives"] == {"define": 1, "include": 2}
+    assert header["resolution_attempts"] == 2
+    assert header["skip_file_hits"] == 1
+    assert header["lines"] == 4
+    assert header["tokens_emitted"] == 6
+    assert header["expansions"] == 3
+    assert header["expansion_depth"] == 2
+    assert header["time"] == 3 and header["self_time"] == 2
+    assert a["name"] == "inc/a.h"
+    assert a["opened"] == 1 and a["lines"] == 4
+    assert a["directives"] == {"define": 1, "endif": 1, "ifndef": 1}
+    assert a["tokens_emitted"] == 2
+    assert a["time"] == a["self_time"] == 1
+    totals = report["totals"]
+    assert totals["directives"] == {"define": 2, "endif": 1, "ifndef": 1,
+                                    "include": 2}
+    assert totals["tokens_emitted"] == 8
+    assert totals["tokens_lexed"] == (header["tokens_lexed"] +
+                                      a["tokens_lexed"])
+
+
+def test_main_stats(tmp_path):
+    input_file = tmp_path / "input.h"
+    input_file.write_text("#define FOO 1\nFOO\n")
+    output_file = tmp_path / "output.h"
+    stats_file = tmp_path / "stats.json"
+    main(["--input-file", str(input_file),
+          "--output-file", str(output_file), "--stats", str(stats_file)])
+    assert output_file.read_text() == "1\n"
+    report = json.loads(stats_file.read_text())
+    assert report["headers"][0]["name"] == str(input_file)
+    assert report["totals"]["directives"] == {"define": 1}
+
+
+def test_prelude_round_trip():
+    headers = {"inc/base.h": ["#ifndef BASE_H\n", "#define BASE_H\n",
+                              "#define WIDTH 4\n", "base\n", "#endif\n"],
+               "inc/once.h": ["#pragma once\n", "#define ONCE 1\n",
+                              "once\n"],
+               "inc/prelude.h": ["#include <base.h>\n",
+                                 "#include <once.h>\n",
+                                 "#define TEMP 1\n", "#undef TEMP\n",
+                                 '#define NAME "name"\n']}
+    main_lines = ["#include <base.h>\n", "#include <once.h>\n",
+                  "WIDTH ONCE NAME TEMP\n"]
+    combined = FakeFile("main.h", ["#include <prelude.h>\n"] + main_lines)
+    expected = "".join(preprocess(combined, header_handler=FakeHandler(
+        headers, ["inc"])))
+    assert expected == "base\nonce\n4 1 \"name\" TEMP\n"
+    for keep_output in (False, True):
+        built = prelude.build(FakeFile("prelude.h",
+                                       ["#include <prelude.h>\n"]),
+                              header_handler=FakeHandler(headers, ["inc"]),
+                              keep_output=keep_output)
+        f_out = io.BytesIO()
+        prelude.dump(built, f_out)
+        loaded = prelude.load(io.BytesIO(f_out.getvalue()))
+        handler = FakeHandler(headers, ["inc"])
+        with mock.patch.object(FakeHandler, "_open", autospec=True,
+                               side_effect=FakeHandler._open) as mock_open:
+            ret = "".join(prelude.preprocess(FakeFile("main.h", main_lines),
+                                             loaded, header_handler=handler))
+        assert mock_open.call_count == 0
+        if keep_output:
+            assert ret == expected
+        else:
+            assert ret == "4 1 \"name\" TEMP\n"
+
+
+def test_prelude_version_mismatch():
+    built = prelude.build(FakeFile("prelude.h", ["#define A 1\n"]))
+    data = bytearray(built.dumps())
+    data[len(prelude.MAGIC)] = prelude.FORMAT_VERSION + 1
+    with pytest.raises(ParseError):
+        prelude.Prelude.loads(bytes(data))
+    with pytest.raises(ParseError):
+        prelude.Prelude.loads(b"garbage")
+    for truncated in (b"", prelude.MAGIC):
+        with pytest.raises(ParseError):
+            prelude.Prelude.loads(truncated)
+    with pytest.raises(ParseError):
+        "".join(prelude.preprocess(FakeFile("main.h", ["A\n"]), built,
+                                   line_ending="\r\n"))
+
+
+def test_target_constants():
+    f_obj = FakeFile("header.h", ["_WIN32 _WIN64 __i386__ __x86_64__\n"])
+    expected = {"windows-32": "1 _WIN64 __i386__ __x86_64__\n",
+                "windows-64": "_WIN32 1 __i386__ __x86_64__\n",
+                "linux-32": "_WIN32 _WIN64 1 __x86_64__\n",
+                "linux-64": "_WIN32 _WIN64 __i386__ 1\n"}
+    with mock.patch(extract_platform_spec_path) as mock_spec:
+        for target, output in expected.items():
+            assert "".join(preprocess(f_obj, target=target)) == output
+        assert mock_spec.call_count == 0
+    with pytest.raises(UnsupportedPlatform):
+        preprocess(f_obj, target="beos-32")
+
+
+def test_platform_constants_lazy():
+    from simplecpreprocessor import core, platform as platform_module
+    with mock.patch.dict(platform_module._CONSTANTS, clear=True), \
+            mock.patch.dict(core._TOKEN_CONSTANTS, clear=True), \
+            mock.patch(extract_platform_spec_path) as mock_spec:
+        mock_spec.return_value = "Windows", "32bit"
+        assert mock_spec.call_count == 0
+        assert core.TOKEN_CONSTANTS is core.token_constants()
+        assert platform_module.PLATFORM_CONSTANTS["_WIN32"] == "1"
+        f_obj = FakeFile("header.h", ["_WIN32\n"])
+        assert "".join(preprocess(f_obj)) == "1\n"
+        assert mock_spec.call_count == 1
+    with pytest.raises(AttributeError):
+        core.MISSING
+
+
+def test_main_target(tmp_path):
+    input_file = tmp_path / "input.h"
+    input_file.write_text("#ifdef _WIN64\nwin64\n#endif\n")
+    output_file = tmp_path / "output.h"
+    main(["--input-file", str(input_file),
+          "--output-file", str(output_file), "--target", "windows-64"])
+    assert output_file.read_text() == "win64\n"
+
+
+@pytest.mark.parametrize("tokenizer_class", [tokens.ArrayTokenizer,
+                                             tokens.ArrayBufferTokenizer])
+def test_array_tokenizer(tokenizer_class):
+    lines = ["#define FOO 1 /* one */\n",
+             "#define BAR FOO + \\\n", "  2\n",
+             "#ifdef BAZ\n", "BAZ\n", "#endif\n",
+             'BAR "str" FOO // comment\n', "last"]
+    expected = "".join(preprocess(FakeFile("header.h", lines)))
+    preprocessor = Preprocessor(tokenizer_class=tokenizer_class,
+                                fold_strings_to_null=True)
+    ret = "".join(preprocessor.preprocess(FakeFile("header.h", lines)))
+    assert ret == expected.replace('"str"', "NULL")
+    body = preprocessor.defines.get("BAR")
+    assert isinstance(body, tokens.ChunkView)
+    assert body.stream is preprocessor.defines.get("FOO").stream
+    assert [t.value for t in body] == ["FOO", " ", "+", " ", "\\", "\n",
+                                       "  ", "2"]
+
+
+def test_chunk_view():
+    stream = tokens.TokenStream()
+    chunk, = stream.read_chunks(Tokenizer(["a + b\n"], "\n"))
+    assert len(stream) == len(chunk) == 6
+    assert [t.value for t in chunk] == ["a", " ", "+", " ", "b", "\n"]
+    assert [t.chunk_mark for t in chunk] == [False] * 5 + [True]
+    assert chunk[-1].kind == tokens.NEWLINE and chunk[-1].whitespace
+    view = chunk[2:-1]
+    assert view.stream is stream
+    assert [t.value for t in view] == ["+", " ", "b"]
+    assert not view[-1].chunk_mark
+    assert [t.value for t in view[::2]] == ["+", "b"]
+    assert len(chunk[4:2]) == 0
+    with pytest.raises(IndexError):
+        view[3]
+
+
+def test_join_lines():
+    f_obj = FakeFile("header.h", ["#include <a.h>\n",
+                                  '#define FOO "foo" + 1\n',
+                                  "FOO  x\n",
+                                  "#pragma pack(push, 8)\n",
+                                  "last"])
+    handler = FakeHandler({"a.h": ["a b\n", "c\n"]}, include_paths=[""])
+    ret = list(preprocess(f_obj, header_handler=handler, join_lines=True,
+                          fold_strings_to_null=True))
+    assert ret == ["a b\n", "c\n", "NULL + 1  x\n",
+                   "#pragma pack(push, 8)\n", "last"]
+    tokens_ret = preprocess(f_obj, header_handler=handler,
+                            fold_strings_to_null=True)
+    assert "".join(tokens_ret) == "".join(ret)
+
+
+def test_chunk_size():
+    f_obj = FakeFile("header.h", ["#define A 1\n"] +
+                     ["line A %d\n" % i for i in range(10)])
+    expected = "".join(preprocess(f_obj))
+    ret = list(preprocess(f_obj, chunk_size=20))
+    assert "".join(ret) == expected
+    assert [len(chunk) >= 20 for chunk in ret] == [True] * 3 + [False]
+    assert preprocess_to_string(f_obj) == expected
+
+
+def test_stats_join_lines():
+    f_obj = FakeFile("header.h", ["#define A 1\n", "A A\n"])
+    collected = stats.Stats()
+    ret = preprocess(f_obj, stats=collected, join_lines=True)
+    assert list(ret) == ["1 1\n"]
+    header, = collected.as_dict()["headers"]
+    assert header["tokens_emitted"] == 4
+    assert header["expansions"] == 2
+
+
+def test_preprocess_bytes():
+    source = ('#include "a.h"\n'
+              '#define GREETING "h\xe9llo \xe0 €" // \xe0\n'
+              "GREETING NAME x\xe0// comment\n")
+    handler = FakeHandler({"a.h": b"#pragma once\na\r\n"},
+                          include_paths=[""], binary=True)
+    for encoding in ("utf-8", "latin-1"):
+        f_obj = io.BytesIO(source.encode(encoding, "replace"))
+        ret = list(preprocess_bytes(f_obj, header_handler=handler,
+                                    extra_constants={b"NAME": b"n\xff"}))
+        expected = (b'a\n', '"h\xe9llo \xe0 €" '.encode(
+            encoding, "replace") + b"n\xff x" + "\xe0".encode(encoding) +
+            b"\n")
+        assert b"".join(ret) == b"".join(expected)
+    ascii_source = FakeFile("header.h", ["#define A 1\n", "A B\n"])
+    assert b"".join(preprocess_bytes(
+        filesystem.BytesFile.from_bytes("header.h", b"#define A 1\nA B\n"),
+        line_ending=b"\r\n")) == preprocess_to_string(
+            ascii_source, line_ending="\r\n").encode("ascii")
+
+
+def test_header_handler_binary(tmp_path):
+    (tmp_path / "a.h").write_bytes(b"#define A \xff\r\nA\n")
+    handler = HeaderHandler([str(tmp_path)], binary=True,
+                            cache_contents=True)
+    f_obj = filesystem.BytesFile.from_bytes("main.h", b"#include <a.h>\n")
+    assert b"".join(preprocess_bytes(f_obj, header_handler=handler)) == \
+        b"\xff\n"
+    opened, = handler.contents.values()
+    assert isinstance(opened, filesystem.BytesFile)
+
+
+def test_main_binary(tmp_path):
+    (tmp_path / "a.h").write_bytes(b"#define A \"\xc3\xa9\"\r\n")
+    input_file = tmp_path / "input.h"
+    input_file.write_bytes(b'#include "a.h"\r\nA\r\n')
+    output_file = tmp_path / "output.h"
+    main(["--input-file", str(input_file), "--output-file",
+          str(output_file), "--binary"])
+    assert output_file.read_bytes() == b'"\xc3\xa9"\n'
+    with pytest.raises(SystemExit):
+        main(["--manifest", "manifest.json", "--binary"])
+
+
+def test_main_pretokenize_skipped_with_result_cache(tmp_path):
+    input_file = tmp_path / "input.h"
+    input_file.write_text("#define FOO 1\nFOO\n")
+    output_file = tmp_path / "output.h"
+    with mock.patch("simplecpreprocessor.batch.pretokenize") as mocked:
+        main(["--input-file", str(input_file),
+              "--output-file", str(output_file), "--jobs", "2",
+              "--cache-dir", str(tmp_path / "cache")])
+    assert not mocked.called
+    assert output_file.read_text() == "1\n"
+
+
+def test_main_stats_with_cache_dir(tmp_path, capsys):
+    input_file = tmp_path / "input.h"
+    input_file.write_text("FOO\n")
+    with pytest.raises(SystemExit):
+        main(["--input-file", str(input_file),
+              "--output-file", str(tmp_path / "output.h"),
+              "--stats", str(tmp_path / "stats.json"),
+              "--cache-dir", str(tmp_path / "cache")])
+    assert "--stats can't be used with --cache-dir" in \
+        capsys.readouterr().err
+
+
+def test_prelude_target():
+    built = prelude.build(FakeFile("prelude.h", ["#ifdef _WIN32\n",
+                                                 "#define WIN 32\n",
+                                                 "#endif\n"]),
+                          target="windows-32")
+    f_obj = FakeFile("main.h", ["WIN _WIN32 _WIN64\n"])
+    ret = prelude.preprocess(f_obj, built, target="windows-32")
+    assert "".join(ret) == "32 1 _WIN64\n"
+    with pytest.raises(ParseError, match="windows-32"):
+        prelude.preprocess(f_obj, built, target="windows-64")
+    loaded = prelude.Prelude.loads(built.dumps())
+    with pytest.raises(ParseError, match="windows-32"):
+        prelude.preprocess(f_obj, loaded)
+
+
+def test_prelude_constants_mismatch():
+    built = prelude.build(FakeFile("prelude.h", ["#define B A\n"]),
+                          extra_constants={"A": "1"})
+    f_obj = FakeFile("main.h", ["B\n"])
+    ret = prelude.preprocess(f_obj, built, extra_constants={"A": "1"})
+    assert "".join(ret) == "1\n"
+    with pytest.raises(ParseError, match="different constants"):
+        prelude.preprocess(f_obj, built, extra_constants={"A": "2"})
+    with pytest.raises(ParseError, match="different constants"):
+        prelude.preprocess(f_obj, built)
+
+
+def test_preprocess_async_target():
+    f_obj = FakeFile("header.h", ["_WIN32 __x86_64__\n"])
+    chunks = _collect_async(preprocess_async(f_obj, aio.MemoryLoader({}),
+                                             target="windows-32"))
+    assert "".join(chunks) == "1 __x86_64__\n"
+
+
+@pytest.mark.parametrize("tokenizer_class", [Tokenizer, BufferTokenizer])
+def test_preprocess_bytes_only_splits_on_newline(tokenizer_class):
+    source = ("int a; // \xc5land comment\n"
+              'char *s = "\xc5land\x0c\r";\n').encode("utf-8")
+    assert b"\x85" in source
+    ret = preprocess_bytes(io.BytesIO(source),
+                           tokenizer_class=tokenizer_class)
+    assert b"".join(ret) == ('int a;\n'
+                             'char *s = "\xc5land\x0c\r";\n').encode("utf-8")
@@ -1,8 +1,33 @@
+import array
+import collections
 import re
+import sys
+
+from .exceptions import ParseError
 
 DEFAULT_LINE_ENDING = "\n"
-TOKEN = re.compile((r"<\w+(?:/\w+)*(?:\.\w+)?>|L?\".+\"|'\w'|/\*|"
-                    r"\*/|//|\b\w+\b|\r\n|\n|[ \t]+|\W"))
+HEADER_NAME = "header_name"
+STRING = "string"
+CHARACTER = "character"
+COMMENT = "comment"
+IDENTIFIER = "identifier"
+NEWLINE = "newline"
+WHITESPACE = "whitespace"
+PUNCTUATION = "punctuation"
+TEXT = "text"
+WHITESPACE_KINDS = (WHITESPACE, NEWLINE)
+KINDS = (HEADER_NAME, STRING, CHARACTER, COMMENT, IDENTIFIER, NEWLINE,
+         WHITESPACE, PUNCTUATION, TEXT)
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+TOKEN = re.compile((r"(?P<header_name><\w+(?:/\w+)*(?:\.\w+)?>)|"
+                    r"(?P<string>L?\".+\")|"
+                    r"(?P<character>'\w')|"
+                    r"(?P<comment>/\*|\*/|//)|"
+                    r"(?P<identifier>\b\w+\b)|"
+                    r"(?P<newline>\r\n|\n)|"
+                    r"(?P<whitespace>[ \t]+|\s)|"
+                    r"(?P<punctuation>\W)"))
+ASCII_TOKEN = re.compile(TOKEN.pattern, re.ASCII)
 CHAR = re.compile(r"^'\w'$")
 CHUNK_MARK = object()
 RSTRIP = object()
@@ -10,30 +35,53 @@ COMMENT_START = ("/*", "//")
 LINE_ENDINGS = ("\r\n", "\n")
 
 
-def is_string(s):
-    return re.search("^L?\".+\"$", s)
+def classify(value):
+    match = TOKEN.fullmatch(value)
+    if match is not None:
+        return match.lastgroup
+    elif not value.strip():
+        return WHITESPACE
+    else:
+        return TEXT
+
 
+def skippable(line):
+    """
+    Tells whether a line in an inactive region can be dropped without
+    tokenizing it: it is complete, not continued, not a directive and
+    doesn't open or close a comment.
+    """
+    if not line.endswith("\n"):
+        return False
+    content = line.rstrip("\r\n")
+    return not (content.endswith("\\") or
+                content.lstrip().startswith("#") or
+                "/*" in content or "*/" in content)
 
-def _tokenize(line_no, line, line_ending):
-    for match in TOKEN.finditer(line):
-        s = match.group(0)
-        if s in LINE_ENDINGS:
-            s = line_ending
-        yield Token.from_string(line_no, s)
+
+def _tokenize(line_no, line, line_ending, pattern=TOKEN):
+    for match in pattern.finditer(line):
+        kind = match.lastgroup
+        if kind == NEWLINE:
+            yield Token(line_no, line_ending, True, NEWLINE)
+        else:
+            yield Token(line_no, match.group(), kind == WHITESPACE, kind)
 
 
 class Token(object):
-    __slots__ = ["line_no", "value", "whitespace", "chunk_mark"]
+    __slots__ = ["line_no", "value", "whitespace", "chunk_mark", "kind"]
 
-    def __init__(self, line_no, value, whitespace):
+    def __init__(self, line_no, value, whitespace, kind=TEXT):
         self.line_no = line_no
         self.value = value
         self.whitespace = whitespace
         self.chunk_mark = False
+        self.kind = kind
 
     @classmethod
     def from_string(cls, line_no, value):
-        return cls(line_no, value, not value.strip())
+        kind = classify(value)
+        return cls(line_no, value, kind in WHITESPACE_KINDS, kind)
 
     @classmethod
     def from_constant(cls, line_no, value):
@@ -44,39 +92,132 @@ class Token(object):
                                             self.value)  # pragma: no cover
 
 
+Expansion = collections.namedtuple("Expansion", ["tokens", "dependencies",
+                                                 "cost", "depth"])
+
+
 class TokenExpander(object):
-    def __init__(self, defines):
+    """
+    Expands macros iteratively with an explicit stack of the macros being
+    expanded. max_depth limits how deeply macros may expand through other
+    macros and max_expansions limits the total number of macro expansions
+    done by this expander. Exceeding either raises ParseError.
+    """
+
+    def __init__(self, defines, max_depth=None, max_expansions=None):
         self.defines = defines
         self.seen = set()
+        self.max_depth = max_depth
+        self.max_expansions = max_expansions
+        self.expansions = 0
+        self.deepest = 0
+
+    def _check_limits(self, origin, depth):
+        if depth > self.deepest:
+            self.deepest = depth
+        if self.max_depth is not None and depth > self.max_depth:
+            fmt = "Expansion of %s on line %s exceeds depth limit %s"
+            raise ParseError(fmt % (origin.value, origin.line_no,
+                                    self.max_depth))
+        if (self.max_expansions is not None and
+                self.expansions > self.max_expansions):
+            fmt = "Expansion of %s on line %s exceeds expansion budget %s"
+            raise ParseError(fmt % (origin.value, origin.line_no,
+                                    self.max_expansions))
 
     def expand_tokens(self, tokens):
-        for token in tokens:
-            if token.value in self.seen:
-                yield token
-            else:
-                resolved = self.defines.get(token.value, token)
+        defines = self.defines
+        seen = self.seen
+        stack = []
+        current = iter(tokens)
+        origin = output = dependencies = None
+        deepest = start = 0
+        while True:
+            for token in current:
+                value = token.value
+                if value in seen:
+                    if stack:
+                        output.append(token)
+                    else:
+                        yield token
+                    continue
+                if stack and not token.whitespace:
+                    dependencies.add(value)
+                resolved = defines.get(value, token)
                 if resolved is token:
-                    yield token
-                else:
-                    self.seen.add(token.value)
-                    for resolved in self.expand_tokens(resolved):
-                        yield resolved
-                    self.seen.remove(token.value)
+                    if stack:
+                        output.append(token)
+                    else:
+                        yield token
+                    continue
+                cached = defines.expansion(value)
+                if cached is not None and seen.isdisjoint(
+                        cached.dependencies):
+                    self.expansions += cached.cost
+                    if stack:
+                        dependencies.update(cached.dependencies)
+                        deepest = max(deepest, len(stack) + cached.depth)
+                        self._check_limits(origin, deepest)
+                        output.extend(cached.tokens)
+                    else:
+                        self._check_limits(token, cached.depth)
+                        yield from cached.tokens
+                    continue
+                if not stack:
+                    origin = token
+                    output = []
+                    dependencies = {value}
+                    deepest = 0
+                    start = self.expansions
+                self.expansions += 1
+                stack.append((current, value))
+                seen.add(value)
+                deepest = max(deepest, len(stack))
+                self._check_limits(origin, deepest)
+                current = iter(resolved)
+                break
+            else:
+                if not stack:
+                    return
+                current, value = stack.pop()
+                seen.remove(value)
+                if not stack:
+                    defines.store_expansion(value, Expansion(
+                        output, frozenset(dependencies),
+                        self.expansions - start, deepest))
+                    yield from output
 
 
 class Tokenizer(object):
+    """
+    Splits a file to tokens and chunks of tokens, one chunk per logical
+    line. If skip is given, it's called at the start of each logical line
+    and while it returns true, lines that can't affect conditionals are
+    dropped without tokenizing them. Files can select the token regex with
+    a token_pattern attribute, as filesystem.BytesFile does.
+    """
     NO_COMMENT = Token.from_constant(None, None)
 
-    def __init__(self, f_obj, line_ending):
+    def __init__(self, f_obj, line_ending, skip=None):
         self.source = enumerate(f_obj)
+        self.pattern = getattr(f_obj, "token_pattern", TOKEN)
         self.line_ending = line_ending
+        self.skip = skip
+        self.skipped_lines = 0
 
     def __iter__(self):
         comment = self.NO_COMMENT
         token = None
         line_no = 0
+        skip = self.skip
         for line_no, line in self.source:
-            tokens = _tokenize(line_no, line, self.line_ending)
+            if (skip is not None and comment is self.NO_COMMENT and
+                    (token is None or token.chunk_mark) and
+                    skippable(line) and skip()):
+                self.skipped_lines += 1
+                continue
+            tokens = _tokenize(line_no, line, self.line_ending,
+                               self.pattern)
             token = next(tokens)
             lookahead = None
             for lookahead in tokens:
@@ -122,3 +263,206 @@ class Tokenizer(object):
                     yield chunk
                 chunk = []
                 continue
+
+
+class BufferTokenizer(Tokenizer):
+    """
+    Tokenizer that reads the whole file at once and scans it with a single
+    pass of the token regex instead of one pass per line. Line numbers are
+    counted from the newlines in the buffer. Produces the same tokens as
+    Tokenizer for files that are iterated line by line.
+    """
+
+    def __init__(self, f_obj, line_ending, skip=None):
+        read = getattr(f_obj, "read", None)
+        if read is not None:
+            self.buffer = read()
+        else:
+            self.buffer = "".join(f_obj)
+        self.pattern = getattr(f_obj, "token_pattern", TOKEN)
+        self.line_ending = line_ending
+        self.skip = skip
+        self.skipped_lines = 0
+
+    def _skip_lines(self, pos):
+        buffer = self.buffer
+        skipped = 0
+        while True:
+            end = buffer.find("\n", pos) + 1
+            if not end or not skippable(buffer[pos:end]):
+                return pos, skipped
+            pos = end
+            skipped += 1
+
+    def __iter__(self):
+        line_ending = self.line_ending
+        comment = self.NO_COMMENT
+        token = None
+        lookahead = None
+        first_in_line = False
+        line_no = 0
+        skip = self.skip
+        pos = 0
+        if skip is not None and skip():
+            pos, line_no = self._skip_lines(pos)
+            self.skipped_lines += line_no
+        matches = self.pattern.finditer(self.buffer, pos)
+        while matches is not None:
+            restart = None
+            for match in matches:
+                kind = match.lastgroup
+                newline = kind == NEWLINE
+                if newline:
+                    value = line_ending
+                    lookahead = Token(line_no, value, True, NEWLINE)
+                else:
+                    value = match.group()
+                    lookahead = Token(line_no, value, kind == WHITESPACE, kind)
+                if token is not None:
+                    if token.value != "\\" and value == line_ending:
+                        lookahead.chunk_mark = True
+                    if token.value == "*/" and comment.value == "/*":
+                        comment = self.NO_COMMENT
+                    elif comment is not self.NO_COMMENT:
+                        pass
+                    elif token.value in COMMENT_START:
+                        comment = token
+                    elif token.whitespace and (value in COMMENT_START or
+                                               value == "#"):
+                        pass
+                    else:
+                        yield token
+                if newline:
+                    if comment.value == "//":
+                        comment = self.NO_COMMENT
+                    if comment is self.NO_COMMENT:
+                        if token is None:
+                            lookahead.chunk_mark = True
+                        yield lookahead
+                    token = None
+                    line_no += 1
+                    if (skip is not None and comment is self.NO_COMMENT and
+                            lookahead.chunk_mark and skip()):
+                        pos, skipped = self._skip_lines(match.end())
+                        if skipped:
+                            line_no += skipped
+                            self.skipped_lines += skipped
+                            restart = self.pattern.finditer(self.buffer,
+                                                            pos)
+                            break
+                else:
+                    first_in_line = token is None
+                    token = lookahead
+            matches = restart
+        if token is not None:
+            if comment.value == "//" and token.value != "\\":
+                comment = self.NO_COMMENT
+            if comment is self.NO_COMMENT:
+                if first_in_line:
+                    token.chunk_mark = True
+                yield token
+        if lookahead is None:
+            lookahead = Token.from_string(0, line_ending)
+            lookahead.chunk_mark = True
+            yield lookahead
+        elif not lookahead.chunk_mark:
+            lookahead = Token.from_string(lookahead.line_no, line_ending)
+            lookahead.chunk_mark = True
+            yield lookahead
+
+
+class TokenStream(object):
+    """
+    Tokens of a file stored in parallel arrays of interned values, line
+    numbers and kinds instead of one Token object per lexeme. Chunks are
+    ChunkViews over the arrays, and so are slices of them, so define
+    bodies share the storage of the file they were defined in.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.line_nos = array.array("l")
+        self.kinds = array.array("B")
+
+    def __len__(self):
+        return len(self.values)
+
+    def token(self, index, chunk_stop):
+        kind = KINDS[self.kinds[index]]
+        token = Token(self.line_nos[index], self.values[index],
+                      kind in WHITESPACE_KINDS, kind)
+        token.chunk_mark = index + 1 == chunk_stop
+        return token
+
+    def read_chunks(self, tokens):
+        values = self.values
+        line_nos = self.line_nos
+        kinds = self.kinds
+        start = len(values)
+        for token in tokens:
+            values.append(sys.intern(token.value))
+            line_nos.append(token.line_no)
+            kinds.append(KIND_CODES[token.kind])
+            if token.chunk_mark:
+                stop = len(values)
+                yield ChunkView(self, start, stop, stop)
+                start = stop
+
+
+class ChunkView(object):
+    """
+    Read-only sequence of the tokens from start to stop of a TokenStream.
+    Tokens are created when accessed and slicing returns another view.
+    """
+    __slots__ = ["stream", "start", "stop", "chunk_stop"]
+
+    def __init__(self, stream, start, stop, chunk_stop):
+        self.stream = stream
+        self.start = start
+        self.stop = stop
+        self.chunk_stop = chunk_stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return ChunkView(self.stream, self.start + start,
+                             self.start + max(start, stop), self.chunk_stop)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chunk index out of range")
+        return self.stream.token(self.start + index, self.chunk_stop)
+
+    def __iter__(self):
+        token = self.stream.token
+        chunk_stop = self.chunk_stop
+        for index in range(self.start, self.stop):
+            yield token(index, chunk_stop)
+
+    def __repr__(self):
+        return "ChunkView({!r})".format(
+            [t.value for t in self])  # pragma: no cover
+
+
+class ArrayChunks(object):
+    """
+    Makes a tokenizer produce ChunkViews over a TokenStream instead of
+    lists of tokens. The stream is kept in the stream attribute.
+    """
+
+    def read_chunks(self):
+        self.stream = TokenStream()
+        return self.stream.read_chunks(iter(self))
+
+
+class ArrayTokenizer(ArrayChunks, Tokenizer):
+    pass
+
+
+class ArrayBufferTokenizer(ArrayChunks, BufferTokenizer):
+    pass